@@ -0,0 +1,361 @@
+# This file is a part of TG-Direct-Link-Generator
+"""
+Offline benchmark of the streaming path.
+
+Runs the real aiohttp app (routes, scheduler, media session pools, chunk caches,
+ByteStreamer.yield_file) against stand-in telegram clients whose media sessions answer
+upload.GetFile locally, with configurable latency, bandwidth, FloodWaits and errors.
+
+    python bench/stream_bench.py --scenario all --latency 80 --bandwidth 8 --clients 3
+
+Reports MB/s, time to first byte, p50/p99 request latency and peak memory per scenario.
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import resource
+from typing import Dict, List
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# the app reads its config on import, keep it offline and in memory
+os.environ.setdefault("API_ID", "1")
+os.environ.setdefault("API_HASH", "bench")
+os.environ.setdefault("BOT_TOKEN", "1:bench")
+os.environ.setdefault("BIN_CHANNEL", "-1001")
+os.environ["METADATA_DB"] = ""
+os.environ["DISK_CACHE_SIZE"] = "0"
+os.environ["WARMUP_MEDIA_SESSIONS"] = "False"
+
+import aiohttp  # noqa: E402
+from aiohttp import web  # noqa: E402
+from pyrogram import raw  # noqa: E402
+from pyrogram.errors import FloodWait  # noqa: E402
+from pyrogram.file_id import FileId, FileType  # noqa: E402
+
+import main  # noqa: E402
+from main.bot import StreamBot, multi_clients, work_loads  # noqa: E402
+from main.server import web_server  # noqa: E402
+from main.utils import media_sessions  # noqa: E402
+from main.utils.chunk_cache import memory_cache  # noqa: E402
+from main.utils.metadata import file_metadata  # noqa: E402
+
+MiB = 1024 * 1024
+HOME_DC = 2
+FILE_DC = 4
+# the content of every fake file: a pattern with a period that isn't a power of two,
+# so a misplaced chunk can't match by accident
+PERIOD = 4099
+PATTERN = bytes(i % 251 for i in range(PERIOD)) * (MiB // PERIOD + 2)
+
+
+def expected_bytes(offset: int, length: int) -> bytes:
+    """Returns the bytes of a fake file, long ranges are built from the repeating pattern."""
+    parts = []
+    while length > 0:
+        start = offset % PERIOD
+        take = min(length, MiB)
+        parts.append(PATTERN[start:start + take])
+        offset += take
+        length -= take
+    return b"".join(parts)
+
+
+class Network:
+    def __init__(self, latency: float, bandwidth: float, flood_rate: float, flood_wait: int, error_rate: float):
+        """How the fake telegram servers behave.
+        attributes:
+            latency: seconds before a GetFile is answered.
+            bandwidth: bytes/sec of a single GetFile answer, 0 for unlimited.
+            flood_rate, error_rate: the chance of a GetFile failing with a FloodWait or a timeout.
+            flood_wait: the seconds a FloodWait asks for.
+        """
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.flood_rate = flood_rate
+        self.flood_wait = flood_wait
+        self.error_rate = error_rate
+        self.requests = 0
+        self.floods = 0
+        self.errors = 0
+        self.file_sizes: Dict[int, int] = {}
+
+
+class FakeStorage:
+    def __init__(self, user_id: int):
+        self._user_id = user_id
+
+    async def test_mode(self):
+        return False
+
+    async def dc_id(self):
+        return HOME_DC
+
+    async def auth_key(self):
+        return b"\0" * 256
+
+    async def user_id(self):
+        return self._user_id
+
+
+class FakeClient:
+    def __init__(self, user_id: int):
+        """Stands in for a pyrogram Client: only what media sessions and the routes use."""
+        self.storage = FakeStorage(user_id)
+        self.username = f"bench_{user_id}"
+
+    async def invoke(self, query):
+        return raw.types.auth.ExportedAuthorization(id=1, bytes=b"bench")
+
+
+class FakeSession:
+    network: Network = None
+
+    def __init__(self, client, dc_id, auth_key, test_mode, is_media=False, is_cdn=False):
+        """Stands in for pyrogram's Session, answering GetFile from the fake files."""
+        self.client = client
+        self.dc_id = dc_id
+        self.is_started = asyncio.Event()
+
+    async def start(self):
+        self.is_started.set()
+
+    async def stop(self):
+        self.is_started.clear()
+
+    async def restart(self):
+        await self.stop()
+        await self.start()
+
+    async def send(self, data, *args, **kwargs):
+        network = self.network
+        if not isinstance(data, raw.functions.upload.GetFile):
+            return True
+        network.requests += 1
+        await asyncio.sleep(network.latency)
+        roll = random.random()
+        if roll < network.flood_rate:
+            network.floods += 1
+            raise FloodWait(value=network.flood_wait)
+        if roll < network.flood_rate + network.error_rate:
+            network.errors += 1
+            raise TimeoutError
+        size = network.file_sizes[data.location.id]
+        length = max(0, min(data.limit, size - data.offset))
+        if network.bandwidth:
+            await asyncio.sleep(length / network.bandwidth)
+        return raw.types.upload.File(
+            type=raw.types.storage.FileUnknown(), mtime=0, bytes=expected_bytes(data.offset, length)
+        )
+
+
+class FakeAuth:
+    def __init__(self, client, dc_id, test_mode):
+        pass
+
+    async def create(self):
+        return b"\1" * 256
+
+
+def install_fakes(network: Network, clients: int) -> None:
+    FakeSession.network = network
+    media_sessions.Session = FakeSession
+    media_sessions.Auth = FakeAuth
+    StreamBot.username = "bench"
+    multi_clients.clear()
+    work_loads.clear()
+    for index in range(clients):
+        multi_clients[index] = FakeClient(1000 + index)
+        work_loads[index] = 0
+    main.Var.MULTI_CLIENT = clients > 1
+
+
+def add_file(network: Network, message_id: int, size: int) -> str:
+    """Puts a fake file in the metadata cache and returns its download path."""
+    media_id = 10_000 + message_id
+    network.file_sizes[media_id] = size
+    file_id = FileId(
+        file_type=FileType.DOCUMENT, dc_id=FILE_DC, media_id=media_id,
+        access_hash=1, file_reference=b"bench",
+    )
+    unique_id = f"AgAD{message_id:06d}bench"
+    for name, value in dict(
+        file_size=size, mime_type="application/octet-stream", file_name=f"bench_{message_id}.bin",
+        unique_id=unique_id, message_id=message_id, date=0, thumb_size="",
+    ).items():
+        setattr(file_id, name, value)
+    file_metadata.put(file_id)
+    return f"/{unique_id[:6]}{message_id}"
+
+
+class Stats:
+    def __init__(self):
+        self.bytes = 0
+        self.ttfb: List[float] = []
+        self.latencies: List[float] = []
+        self.failures = 0
+
+    def report(self, name: str, elapsed: float, network: Network) -> dict:
+        def percentile(values, p):
+            if not values:
+                return 0.0
+            values = sorted(values)
+            return values[min(len(values) - 1, int(len(values) * p))]
+
+        return {
+            "scenario": name,
+            "requests": len(self.latencies),
+            "failures": self.failures,
+            "mb_per_sec": round(self.bytes / MiB / elapsed, 2) if elapsed else 0.0,
+            "ttfb_p50_ms": round(percentile(self.ttfb, 0.5) * 1000, 1),
+            "ttfb_p99_ms": round(percentile(self.ttfb, 0.99) * 1000, 1),
+            "latency_p50_ms": round(percentile(self.latencies, 0.5) * 1000, 1),
+            "latency_p99_ms": round(percentile(self.latencies, 0.99) * 1000, 1),
+            "getfile_requests": network.requests,
+            "flood_waits": network.floods,
+            "errors": network.errors,
+            "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        }
+
+
+async def fetch(session: aiohttp.ClientSession, url: str, stats: Stats, verify: bool,
+                first: int = 0, last: int = None) -> None:
+    headers = {"Range": f"bytes={first}-{'' if last is None else last}"} if first or last is not None else {}
+    started = time.monotonic()
+    received = 0
+    ttfb = None
+    chunks = []
+    try:
+        async with session.get(url, headers=headers) as response:
+            if response.status not in (200, 206):
+                stats.failures += 1
+                return
+            async for data in response.content.iter_any():
+                if ttfb is None:
+                    ttfb = time.monotonic() - started
+                received += len(data)
+                if verify:
+                    chunks.append(data)
+            expected = int(response.headers["Content-Length"])
+    except aiohttp.ClientError:
+        stats.failures += 1
+        return
+    if received != expected or (verify and b"".join(chunks) != expected_bytes(first, expected)):
+        stats.failures += 1
+    stats.bytes += received
+    stats.ttfb.append(ttfb or 0.0)
+    stats.latencies.append(time.monotonic() - started)
+
+
+async def sequential(base: str, network: Network, args) -> Stats:
+    """One viewer downloading a whole file."""
+    stats = Stats()
+    path = add_file(network, 1, args.file_size * MiB)
+    async with aiohttp.ClientSession() as session:
+        await fetch(session, base + path, stats, args.verify)
+    return stats
+
+
+async def seek_storm(base: str, network: Network, args) -> Stats:
+    """Viewers jumping around a file: many short random ranges, a few at a time."""
+    stats = Stats()
+    size = args.file_size * MiB
+    path = add_file(network, 2, size)
+    semaphore = asyncio.Semaphore(args.viewers)
+
+    async def seek():
+        async with semaphore:
+            first = random.randrange(0, size - 1)
+            last = min(size - 1, first + random.randrange(64 * 1024, 2 * MiB))
+            await fetch(session, base + path, stats, args.verify, first, last)
+
+    async with aiohttp.ClientSession() as session:
+        await asyncio.gather(*[seek() for _ in range(args.seeks)])
+    return stats
+
+
+async def concurrent_viewers(base: str, network: Network, args) -> Stats:
+    """Many viewers downloading at once, half of them the same popular file."""
+    stats = Stats()
+    size = args.file_size * MiB
+    popular = add_file(network, 3, size)
+    paths = [popular if i % 2 else add_file(network, 100 + i, size) for i in range(args.viewers)]
+    connector = aiohttp.TCPConnector(limit=0)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        await asyncio.gather(*[fetch(session, base + path, stats, args.verify) for path in paths])
+    return stats
+
+
+SCENARIOS = {
+    "sequential": sequential,
+    "seek_storm": seek_storm,
+    "concurrent": concurrent_viewers,
+}
+
+
+async def run(args) -> List[dict]:
+    network = Network(
+        args.latency / 1000, args.bandwidth * MiB, args.flood_rate, args.flood_wait, args.error_rate
+    )
+    install_fakes(network, args.clients)
+    runner = web.AppRunner(web_server())
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    base = f"http://127.0.0.1:{port}"
+
+    results = []
+    names = list(SCENARIOS) if args.scenario == "all" else [args.scenario]
+    try:
+        for name in names:
+            # every scenario starts cold
+            memory_cache.chunks.clear()
+            memory_cache.frequency.clear()
+            memory_cache.used_bytes = 0
+            network.requests = network.floods = network.errors = 0
+            started = time.monotonic()
+            stats = await SCENARIOS[name](base, network, args)
+            results.append(stats.report(name, time.monotonic() - started, network))
+    finally:
+        await runner.cleanup()
+        for pool in list(media_sessions.media_session_pools.values()):
+            await pool.stop()
+        if media_sessions.health_task is not None:
+            media_sessions.health_task.cancel()
+    return results
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scenario", default="all", choices=["all", *SCENARIOS])
+    parser.add_argument("--clients", type=int, default=2, help="fake bots in multi_clients")
+    parser.add_argument("--latency", type=float, default=50, help="ms before a GetFile is answered")
+    parser.add_argument("--bandwidth", type=float, default=0, help="MiB/s of a GetFile answer, 0 is unlimited")
+    parser.add_argument("--flood-rate", type=float, default=0.0, help="chance of a GetFile FloodWait")
+    parser.add_argument("--flood-wait", type=int, default=5, help="seconds a FloodWait asks for")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="chance of a GetFile timeout")
+    parser.add_argument("--file-size", type=int, default=64, help="MiB per fake file")
+    parser.add_argument("--viewers", type=int, default=16, help="concurrent viewers")
+    parser.add_argument("--seeks", type=int, default=200, help="ranges requested by seek_storm")
+    parser.add_argument("--verify", action="store_true", help="check every received byte")
+    parser.add_argument("--json", action="store_true", help="print the results as JSON")
+    args = parser.parse_args()
+
+    results = asyncio.run(run(args))
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    columns = list(results[0])
+    print("  ".join(f"{c:>15}" for c in columns))
+    for result in results:
+        print("  ".join(f"{str(result[c]):>15}" for c in columns))
+
+
+if __name__ == "__main__":
+    main_cli()
@@ -3,7 +3,15 @@
 
 import time
 from .vars import Var
-from main.bot.clients import StreamBot
 
+# set before the clients are imported, the web server modules they pull in read them
 __version__ = 2.2
 StartTime = time.time()
+
+
+def __getattr__(name):
+    # the clients are imported on first use, so the worker supervisor never creates them
+    if name == "StreamBot":
+        from main.bot.clients import StreamBot
+        return StreamBot
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -4,12 +4,7 @@ import sys
 import asyncio
 import logging
 from .vars import Var
-from aiohttp import web
-from pyrogram import idle
-from main import utils
-from main import StreamBot
-from main.server import web_server
-from main.bot.clients import initialize_clients
+from main.utils.workers import supervise
 
 
 logging.basicConfig(
@@ -23,6 +18,20 @@ logging.getLogger("aiohttp").setLevel(logging.ERROR)
 logging.getLogger("pyrogram").setLevel(logging.ERROR)
 logging.getLogger("aiohttp.web").setLevel(logging.ERROR)
 
+if __name__ == "__main__" and Var.WEB_WORKERS > 1 and Var.WORKER_INDEX < 0:
+    # the supervisor only runs the workers, it never opens the clients, caches or metadata store
+    sys.exit(supervise())
+
+from aiohttp import web  # noqa: E402
+from pyrogram import idle  # noqa: E402
+from main import utils  # noqa: E402
+from main import StreamBot  # noqa: E402
+from main.server import web_server  # noqa: E402
+from main.bot import multi_clients  # noqa: E402
+from main.bot.clients import initialize_clients  # noqa: E402
+from main.utils.metadata import file_metadata  # noqa: E402
+from main.utils.media_sessions import warm_up_media_sessions  # noqa: E402
+
 server = web.AppRunner(web_server())
 
 if sys.version_info[1] > 9:
@@ -32,32 +41,43 @@ else:
     loop = asyncio.get_event_loop()
 
 async def start_services():
-    print()
-    print("-------------------- Initializing Telegram Bot --------------------")
-    await StreamBot.start()
-    bot_info = await StreamBot.get_me()
-    StreamBot.username = bot_info.username
-    print("------------------------------ DONE ------------------------------")
+    # with several workers only worker 0 runs the main bot and answers its updates
+    main_bot = Var.WORKER_INDEX <= 0
+    if Var.WORKER_INDEX >= 0:
+        print("                        worker =>> {} of {}".format(Var.WORKER_INDEX, Var.WEB_WORKERS))
+    if main_bot:
+        print()
+        print("-------------------- Initializing Telegram Bot --------------------")
+        await StreamBot.start()
+        bot_info = await StreamBot.get_me()
+        StreamBot.username = bot_info.username
+        print("------------------------------ DONE ------------------------------")
     print()
     print(
         "---------------------- Initializing Clients ----------------------"
     )
     await initialize_clients()
     print("------------------------------ DONE ------------------------------")
-    if Var.ON_HEROKU:
+    if Var.WARMUP_MEDIA_SESSIONS:
+        dc_ids = Var.WARMUP_DCS or file_metadata.top_dcs(3)
+        print("------------------ Warming Up Media Sessions ------------------")
+        print("                        DC IDs =>> {}".format(dc_ids))
+        asyncio.create_task(warm_up_media_sessions(list(multi_clients.values()), dc_ids))
+    if Var.ON_HEROKU and main_bot:
         print("------------------ Starting Keep Alive Service ------------------")
         print()
         asyncio.create_task(utils.ping_server())
     print("--------------------- Initalizing Web Server ---------------------")
     await server.setup()
     bind_address = "0.0.0.0" if Var.ON_HEROKU else Var.BIND_ADDRESS
-    await web.TCPSite(server, bind_address, Var.PORT).start()
+    await web.TCPSite(server, bind_address, Var.PORT, reuse_port=Var.WORKER_INDEX >= 0).start()
     print("------------------------------ DONE ------------------------------")
     print()
     print("------------------------- Service Started -------------------------")
-    print("                        bot =>> {}".format(bot_info.first_name))
-    if bot_info.dc_id:
-        print("                        DC ID =>> {}".format(str(bot_info.dc_id)))
+    if main_bot:
+        print("                        bot =>> {}".format(bot_info.first_name))
+        if bot_info.dc_id:
+            print("                        DC ID =>> {}".format(str(bot_info.dc_id)))
     print("                        server ip =>> {}".format(bind_address, Var.PORT))
     if Var.ON_HEROKU:
         print("                        app running on =>> {}".format(Var.FQDN))
@@ -74,7 +94,8 @@ async def start_services():
 
 async def cleanup():
     await server.cleanup()
-    await StreamBot.stop()
+    if StreamBot.is_connected:
+        await StreamBot.stop()
 
 if __name__ == "__main__":
     try:
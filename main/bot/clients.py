@@ -5,36 +5,43 @@ import logging
 from ..vars import Var
 from pyrogram import Client
 from main.utils import TokenParser
+from main.utils.workers import worker_tokens
 from . import multi_clients, work_loads, StreamBot
 
 
 async def initialize_clients():
     SESSION_STRING_SIZE = 351
-    multi_clients[0] = StreamBot
-    work_loads[0] = 0
+    # with several workers the main bot only runs in worker 0, the others get their share of MULTI_TOKENs
+    if Var.WORKER_INDEX <= 0:
+        multi_clients[0] = StreamBot
+        work_loads[0] = 0
     all_tokens = TokenParser().parse_from_env()
+    if Var.WORKER_INDEX >= 0:
+        all_tokens = worker_tokens(all_tokens, Var.WORKER_INDEX, Var.WEB_WORKERS)
     if not all_tokens:
         print("No additional clients found, using default client")
         return
     
     async def start_client(client_id, token):
         try:
-            if len(token) >= 351:
-                session_name=token
+            if len(token) >= SESSION_STRING_SIZE:
+                session_string=token
                 bot_token=None
                 print(f"Starting - Client {client_id} using Session Strings")
             else:
-                session_name=":memory:"
+                session_string=None
                 bot_token=token
                 print(f"Starting - Client {client_id} using Bot Token")
             if client_id == len(all_tokens):
                 await asyncio.sleep(2)
                 print("This will take some time, please wait...")
             client = await Client(
-                session_name=session_name,
+                name=str(client_id),
                 api_id=Var.API_ID,
                 api_hash=Var.API_HASH,
                 bot_token=bot_token,
+                session_string=session_string,
+                in_memory=True,
                 sleep_threshold=Var.SLEEP_THRESHOLD,
                 no_updates=True,
             ).start()
@@ -48,7 +48,7 @@ async def channel_receive_handler(bot, broadcast: Message):
         return
     try:
         log_msg = await broadcast.forward(chat_id=Var.BIN_CHANNEL)
-        log_msg_id = log_msg.message_id
+        log_msg_id = log_msg.id
         stream_link = "https://{}/{}".format(Var.FQDN, log_msg_id) if Var.ON_HEROKU or Var.NO_PORT else \
             "http://{}:{}/{}".format(Var.FQDN,
                                     Var.PORT,
@@ -60,7 +60,7 @@ async def channel_receive_handler(bot, broadcast: Message):
         )
         await bot.edit_message_reply_markup(
             chat_id=broadcast.chat.id,
-            message_id=broadcast.message_id,
+            message_id=broadcast.id,
             reply_markup=InlineKeyboardMarkup(
                 [[InlineKeyboardButton("Download Link 📥", url=stream_link)]])
         )
@@ -79,7 +79,7 @@ async def channel_receive_handler(bot, broadcast: Message):
 async def private_receive_handler(c: Client, m: Message):
     try:
         log_msg = await m.forward(chat_id=Var.BIN_CHANNEL)
-        log_msg_id = log_msg.message_id
+        log_msg_id = log_msg.id
         reply_markup, Stream_Text, stream_link = await gen_link(m=m, log_msg=log_msg, from_channel=True)
         await StreamBot.send_message(chat_id=Var.BIN_CHANNEL,text=f"**Requested By :** [{m.chat.first_name}](tg://user?id={m.chat.id})\n**Group ID :** `{m.from_user.id}`\n**Download Link :** {stream_link}", disable_web_page_preview=True, reply_to_message_id=m.id)
 
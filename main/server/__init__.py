@@ -1,26 +1,51 @@
 import aiohttp
 from aiohttp import web
 from aiohttp import CookieJar
-from .stream_routes import routes as stream_routes_routes
-from .prox import routes as prox_routes_routes, check_deno_and_script
 import asyncio
 import logging
 
 
 async def startup_tasks(app):
+    from main.vars import Var
+    from .prox import check_deno_and_script, make_proxy_session
     logging.info("Running startup tasks...")
     app['cookie_jar'] = CookieJar(unsafe=True)
     logging.info("CookieJar created and attached to app state.")
+    app['proxy_session'] = make_proxy_session()
 
+    if Var.HTML_REWRITER != 'deno':
+        return
     await check_deno_and_script()
     logging.info("Deno and script check completed.")
+    # the first proxied requests don't wait for Deno to start
+    asyncio.ensure_future(start_deno_pool())
+
+
+async def start_deno_pool():
+    from .prox import deno_pool
+    try:
+        await deno_pool.start()
+    except Exception as e:
+        logging.error(f"Failed starting the Deno workers: {e!r}")
+
+
+async def cleanup_tasks(app):
+    from . import prox
+    await app['proxy_session'].close()
+    await prox.deno_pool.stop()
+    if prox.html_pool is not None:
+        prox.html_pool.shutdown(wait=False)
 
 
 def web_server():
+    # imported here, so importing main.server.exceptions doesn't pull in every route
+    from .stream_routes import routes as stream_routes_routes
+    from .prox import routes as prox_routes_routes
     logging.info("Creating web application...")
     web_app = web.Application(client_max_size=30000000)
 
     web_app.on_startup.append(startup_tasks)
+    web_app.on_cleanup.append(cleanup_tasks)
     logging.info("Startup task registered.")
 
     web_app.add_routes(prox_routes_routes)
@@ -0,0 +1,220 @@
+import json
+import time
+import struct
+import asyncio
+import logging
+import subprocess
+from typing import Dict, List, Optional
+
+# requests a worker handles at once before the pool starts another one
+WORKER_CONCURRENCY = 16
+# workers above DENO_WORKERS that were idle this long are stopped
+IDLE_TIMEOUT = 60
+# seconds a worker gets to finish its requests when it's stopped
+STOP_TIMEOUT = 10
+# seconds between sweeps, so idle and retired workers are stopped while no requests come in
+SWEEP_INTERVAL = 15
+_LENGTH = struct.Struct(">I")
+
+
+class DenoWorkerError(Exception):
+    """A Deno worker died or answered something that isn't a response frame."""
+    pass
+
+
+class DenoWorker:
+    def __init__(self, command: List[str]):
+        """A long running `proxy.ts --serve` process handling many requests.
+        Requests and responses are length prefixed JSON frames, matched by their id.
+        attributes:
+            in_flight: the requests waiting for a response.
+            served: how many requests were sent to the worker.
+            retired: the worker gets no new requests and stops once it's idle.
+
+        functions:
+            start: starts the process.
+            request: sends a request and waits for its response.
+            stop: closes the worker's stdin, so it exits after its last response.
+        """
+        self.command = command
+        self.process: Optional[asyncio.subprocess.Process] = None
+        self.pending: Dict[int, asyncio.Future] = {}
+        self.next_id = 0
+        self.served = 0
+        self.retired = False
+        self.last_used = time.monotonic()
+        self.reader: Optional[asyncio.Task] = None
+
+    @property
+    def in_flight(self) -> int:
+        return len(self.pending)
+
+    @property
+    def alive(self) -> bool:
+        return self.process is not None and self.process.returncode is None and not self.reader.done()
+
+    async def start(self) -> None:
+        self.process = await asyncio.create_subprocess_exec(
+            *self.command,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+        )
+        self.reader = asyncio.ensure_future(self.read_responses())
+        logging.info(f"Started Deno worker (pid {self.process.pid})")
+
+    async def read_responses(self) -> None:
+        error = DenoWorkerError("Deno worker exited")
+        try:
+            while True:
+                length, = _LENGTH.unpack(await self.process.stdout.readexactly(_LENGTH.size))
+                response = json.loads(await self.process.stdout.readexactly(length))
+                future = self.pending.pop(response.pop("id", None), None)
+                if future is not None and not future.done():
+                    future.set_result(response)
+        except asyncio.IncompleteReadError:
+            pass
+        except (ValueError, OSError) as e:
+            error = DenoWorkerError(f"Broken response from the Deno worker: {e!r}")
+            logging.error(f"{error}, stopping it")
+            self.process.kill()
+        for future in self.pending.values():
+            if not future.done():
+                future.set_exception(error)
+        self.pending.clear()
+
+    async def request(self, data: dict, timeout: float) -> dict:
+        self.next_id += 1
+        self.served += 1
+        self.last_used = time.monotonic()
+        request_id = self.next_id
+        future = self.pending[request_id] = asyncio.get_event_loop().create_future()
+        payload = json.dumps({**data, "id": request_id}).encode("utf-8")
+        try:
+            self.process.stdin.write(_LENGTH.pack(len(payload)) + payload)
+            await self.process.stdin.drain()
+            return await asyncio.wait_for(future, timeout)
+        except (BrokenPipeError, ConnectionResetError) as e:
+            raise DenoWorkerError(f"Deno worker exited: {e!r}")
+        finally:
+            self.pending.pop(request_id, None)
+            self.last_used = time.monotonic()
+
+    async def stop(self) -> None:
+        if self.process is None or self.process.returncode is not None:
+            return
+        try:
+            self.process.stdin.close()
+            await asyncio.wait_for(self.process.wait(), STOP_TIMEOUT)
+        except asyncio.TimeoutError:
+            self.process.kill()
+            await self.process.wait()
+        except OSError:
+            pass
+        logging.info(f"Stopped Deno worker (pid {self.process.pid}) after {self.served} requests")
+
+
+class DenoPool:
+    def __init__(self, command: List[str], min_workers: int, max_workers: int, max_requests: int):
+        """Persistent Deno workers the proxy requests are spread over, so a request
+        doesn't pay for starting Deno and importing the scripts.
+        attributes:
+            min_workers: workers kept running, started with the web server.
+            max_workers: the most workers, another one starts when every worker has WORKER_CONCURRENCY requests.
+            max_requests: requests after which a worker is replaced (recycled), 0 never replaces them.
+
+        functions:
+            start: starts min_workers workers and the periodic sweep.
+            request: sends a request to the least busy worker and returns its response.
+            stop: stops the sweep and every worker.
+        """
+        self.command = command
+        self.min_workers = max(1, min_workers)
+        self.max_workers = max(self.min_workers, max_workers)
+        self.max_requests = max_requests
+        self.workers: List[DenoWorker] = []
+        self._lock: Optional[asyncio.Lock] = None
+        self.sweeper: Optional[asyncio.Task] = None
+
+    @property
+    def lock(self) -> asyncio.Lock:
+        # created on first use, inside the running event loop
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        return self._lock
+
+    async def start(self) -> None:
+        if self.sweeper is None:
+            self.sweeper = asyncio.ensure_future(self.sweep_periodically())
+        async with self.lock:
+            while len(self.workers) < self.min_workers:
+                await self.add_worker()
+
+    async def sweep_periodically(self) -> None:
+        while True:
+            await asyncio.sleep(SWEEP_INTERVAL)
+            try:
+                self.sweep()
+            except Exception as e:
+                logging.error(f"Failed sweeping the Deno workers: {e!r}")
+
+    async def add_worker(self) -> DenoWorker:
+        worker = DenoWorker(self.command)
+        await worker.start()
+        self.workers.append(worker)
+        return worker
+
+    async def pick(self) -> DenoWorker:
+        """
+        Returns the least busy live worker, starting another one if they're all busy.
+        """
+        self.sweep()
+        usable = [w for w in self.workers if not w.retired and w.alive]
+        worker = min(usable, key=lambda w: w.in_flight, default=None)
+        if worker is not None and (worker.in_flight < WORKER_CONCURRENCY or len(self.workers) >= self.max_workers):
+            return worker
+        async with self.lock:
+            usable = [w for w in self.workers if not w.retired and w.alive]
+            idle = [w for w in usable if w.in_flight < WORKER_CONCURRENCY]
+            if idle or (usable and len(self.workers) >= self.max_workers):
+                return min(idle or usable, key=lambda w: w.in_flight)
+            return await self.add_worker()
+
+    def sweep(self) -> None:
+        """
+        Drops dead workers, retires the ones that served max_requests or idled above min_workers,
+        and stops the retired ones once they're idle.
+        """
+        now = time.monotonic()
+        active = [w for w in self.workers if w.alive and not w.retired]
+        for worker in list(active):
+            if self.max_requests and worker.served >= self.max_requests:
+                worker.retired = True
+            elif len(active) > self.min_workers and not worker.in_flight and now - worker.last_used > IDLE_TIMEOUT:
+                worker.retired = True
+                active.remove(worker)
+        for worker in list(self.workers):
+            if not worker.alive:
+                self.workers.remove(worker)
+            elif worker.retired and not worker.in_flight:
+                self.workers.remove(worker)
+                asyncio.ensure_future(worker.stop())
+
+    async def request(self, data: dict, timeout: float) -> dict:
+        worker = await self.pick()
+        try:
+            return await worker.request(data, timeout)
+        except asyncio.TimeoutError:
+            # the worker may be stuck, it's replaced once its other requests are done
+            worker.retired = True
+            raise
+
+    async def stop(self) -> None:
+        if self.sweeper is not None:
+            self.sweeper.cancel()
+            self.sweeper = None
+        workers, self.workers = self.workers, []
+        await asyncio.gather(*[worker.stop() for worker in workers])
+
+
+def deno_command(script_path: str) -> List[str]:
+    return ["deno", "run", "-A", script_path, "--serve"]
@@ -0,0 +1,255 @@
+import re
+import html
+import zlib
+import codecs
+from functools import lru_cache
+from typing import Dict, List, Optional
+from urllib.parse import urljoin, urlsplit, urlunsplit
+
+# the elements parsing.ts selects: a[href], link[href], script[src], img[src], form[action]
+SELECTORS = {"a": "href", "link": "href", "script": "src", "img": "src", "form": "action"}
+REWRITTEN_ATTRIBUTES = ("href", "src", "action")
+# elements whose content isn't markup, a "<" in them doesn't start a tag
+RAW_TEXT_ELEMENTS = {"script", "style", "textarea", "title", "xmp", "iframe", "noembed", "noframes"}
+# a tag or comment longer than this is passed on as text instead of waiting for its end
+MAX_PENDING = 256 * 1024
+
+# the script jq.ts appends to <head>
+INJECTED_SCRIPT = """
+<script>
+$(function(){
+
+
+   $(".P2P").remove();
+   $("#loadProviders a").each( function(){
+     let src = decodeURIComponent( $(this).attr("href") ).split("=")[1]
+     $(this).attr("href", src)
+     })
+
+  });
+  </script>
+"""
+
+_SKIPPED_URL = re.compile(r"^(mailto|tel|javascript|#|data):")
+_TAG_NAME = re.compile(r"[a-zA-Z][^\s/>]*")
+# the markup the rewriter acts on, the rest of the page is searched past in one go
+_INTERESTING = re.compile(
+    r"<(?:!--|/head[\s/>]|(?:" + "|".join(sorted(set(SELECTORS) | RAW_TEXT_ELEMENTS | {"body"})) + r")[\s/>])",
+    re.IGNORECASE,
+)
+_LONGEST_INTERESTING = max(len(name) for name in RAW_TEXT_ELEMENTS) + 3
+# one alternative per character or quoted value, so a tag cut in half fails fast instead of backtracking
+_START_TAG = re.compile(r"""<([a-zA-Z][^\s/>]*)((?:[^>"'=]|=\s*"[^"]*"|=\s*'[^']*'|=)*)>""")
+_LENIENT_START_TAG = re.compile(r"<([a-zA-Z][^\s/>]*)([^>]*)>")
+# what urljoin would change in an absolute path: dot segments, backslashes and whitespace
+_NEEDS_RESOLVING = re.compile(r"/\.|\\|\s")
+_ATTRIBUTE = re.compile(r"""([^\s"'>/=]+)(?:(\s*=\s*)("[^"]*"|'[^']*'|[^\s>"']*))?""")
+
+
+@lru_cache(maxsize=64)
+def _hostname(url: str) -> Optional[str]:
+    return urlsplit(url).hostname
+
+
+def rewrite_url(current_page_url: str, base_url: str, proxy_prefix: str, url: str) -> str:
+    """
+    Points a link of a proxied page at the proxy, like rewriteUrl in parsing.ts:
+    links to the proxied site become proxy_prefix + path, others are made absolute.
+    """
+    if not url or _SKIPPED_URL.match(url):
+        return url
+    same_site = _hostname(current_page_url) == _hostname(base_url)
+    if same_site and url[0] == "/" and not url.startswith("//") and not _NEEDS_RESOLVING.search(url):
+        # most links are absolute paths on the proxied site, they don't need joining
+        path, _, query = url.partition("#")[0].partition("?")
+        return proxy_prefix.rstrip("/") + "/" + (path + ("?" + query if query else "")).lstrip("/")
+    try:
+        parts = urlsplit(urljoin(current_page_url, url.strip()))
+        if parts.hostname != _hostname(base_url):
+            if parts.scheme in ("http", "https") and not parts.path:
+                parts = parts._replace(path="/")
+            return urlunsplit(parts)
+        final_path = (parts.path or "/") + ("?" + parts.query if parts.query else "")
+        return proxy_prefix.rstrip("/") + "/" + final_path.lstrip("/")
+    except ValueError:
+        return url
+
+
+class HtmlRewriter:
+    def __init__(self, current_page_url: str, base_url: str, proxy_prefix: str):
+        """Rewrites the links of an HTML page as its text arrives, without building a DOM.
+        Only the href/src/action values of the elements parsing.ts selects change,
+        everything else is passed on as it came. The jq.ts script goes at the end of <head>.
+
+        functions:
+            feed: takes the next piece of the page, returns the rewritten text that is ready.
+        """
+        self.current_page_url = current_page_url
+        self.base_url = base_url
+        self.proxy_prefix = proxy_prefix
+        self.pending = ""
+        self.raw_end: Optional["re.Pattern"] = None
+        self.injected = False
+        # pages link to the same URLs over and over
+        self.rewritten: Dict[str, str] = {}
+
+    def feed(self, text: str, final: bool = False) -> str:
+        """
+        Returns the rewritten text up to the last complete token, the rest is kept for the next call.
+        With final the whole page has arrived and everything is returned.
+        """
+        data = self.pending + text
+        out: List[str] = []
+        position = 0
+        end = len(data)
+        while position < end:
+            if self.raw_end is not None:
+                match = self.raw_end.search(data, position)
+                if match is None:
+                    # the end tag may be cut in half, its start stays pending
+                    keep = end if final else max(position, end - len(self.raw_end.pattern))
+                    out.append(data[position:keep])
+                    position = keep
+                    break
+                out.append(data[position:match.start()])
+                position = match.start()
+                self.raw_end = None
+                continue
+            found = _INTERESTING.search(data, position)
+            if found is None:
+                # other tags are passed on as text, only the start of a cut off tag stays pending
+                tail = -1 if final else data.rfind("<", max(position, end - _LONGEST_INTERESTING), end)
+                keep = end if tail < 0 else tail
+                out.append(data[position:keep])
+                position = keep
+                break
+            tag = found.start()
+            out.append(data[position:tag])
+            position = self.token(data, tag, final or end - tag > MAX_PENDING, out)
+            if position is None:
+                position = tag
+                break
+        self.pending = data[position:]
+        if final:
+            out.append(self.pending)
+            self.pending = ""
+            self.inject(out)
+        return "".join(out)
+
+    def token(self, data: str, start: int, force: bool, out: List[str]) -> Optional[int]:
+        """
+        Passes on the markup at data[start] ("<"), returns where it ends, or None if it isn't complete yet.
+        With force an incomplete token is passed on as text.
+        """
+        if data.startswith("<!--", start):
+            close = data.find("-->", start + 4)
+            if close < 0:
+                return self.incomplete(data, start, force, out)
+            out.append(data[start:close + 3])
+            return close + 3
+        if data.startswith(("<!", "<?", "</"), start):
+            close = data.find(">", start)
+            if close < 0:
+                return self.incomplete(data, start, force, out)
+            name = _TAG_NAME.match(data, start + 2)
+            if data[start + 1] == "/" and name and name.group(0).lower() == "head":
+                self.inject(out)
+            out.append(data[start:close + 1])
+            return close + 1
+        if start + 1 < len(data) and data[start + 1].isascii() and data[start + 1].isalpha():
+            match = _START_TAG.match(data, start)
+            if match is None:
+                if not force:
+                    return None
+                match = _LENIENT_START_TAG.match(data, start)
+                if match is None:
+                    out.append("<")
+                    return start + 1
+            name = match.group(1).lower()
+            if name == "body":
+                self.inject(out)
+            out.append(self.start_tag(name, match))
+            if name in RAW_TEXT_ELEMENTS and not match.group(2).rstrip().endswith("/"):
+                self.raw_end = re.compile(r"</" + re.escape(name) + r"[\s/>]", re.IGNORECASE)
+            return match.end()
+        if start + 1 >= len(data) and not force:
+            return None
+        out.append("<")
+        return start + 1
+
+    @staticmethod
+    def incomplete(data: str, start: int, force: bool, out: List[str]) -> Optional[int]:
+        if not force:
+            return None
+        out.append(data[start:])
+        return len(data)
+
+    def start_tag(self, name: str, match: "re.Match") -> str:
+        selector = SELECTORS.get(name)
+        attributes = match.group(2)
+        if selector is None:
+            return match.group(0)
+        names = [a.group(1).lower() for a in _ATTRIBUTE.finditer(attributes)]
+        if selector not in names:
+            return match.group(0)
+        return "<" + match.group(1) + _ATTRIBUTE.sub(self.rewrite_attribute, attributes) + ">"
+
+    def rewrite_attribute(self, match: "re.Match") -> str:
+        raw = match.group(3)
+        if match.group(1).lower() not in REWRITTEN_ATTRIBUTES or not raw:
+            return match.group(0)
+        quote = raw[0] if raw[0] in "\"'" else ""
+        value = html.unescape(raw[1:-1] if quote else raw)
+        if not value:
+            return match.group(0)
+        rewritten = self.rewritten.get(value)
+        if rewritten is None:
+            rewritten = self.rewritten[value] = rewrite_url(self.current_page_url, self.base_url, self.proxy_prefix, value)
+        if rewritten == value:
+            return match.group(0)
+        quote = quote or '"'
+        escaped = rewritten.replace("&", "&amp;").replace(quote, "&quot;" if quote == '"' else "&#39;")
+        return f"{match.group(1)}{match.group(2)}{quote}{escaped}{quote}"
+
+    def inject(self, out: List[str]) -> None:
+        if not self.injected:
+            self.injected = True
+            out.append(INJECTED_SCRIPT)
+
+
+def rewrite_html(page: str, current_page_url: str, base_url: str, proxy_prefix: str) -> str:
+    """
+    Rewrites a whole page at once, e.g. in a worker process.
+    """
+    return HtmlRewriter(current_page_url, base_url, proxy_prefix).feed(page, final=True)
+
+
+class BodyDecoder:
+    def __init__(self, content_encoding: str):
+        """Turns the (gzip or deflate compressed) bytes of a page into text as they arrive.
+        Like parsing.ts the text is read as UTF-8.
+
+        functions:
+            decode: returns the text of the next bytes, with final the rest of it.
+        """
+        encoding = content_encoding.strip().lower()
+        self.deflate = encoding == "deflate"
+        # 32 + MAX_WBITS reads gzip and zlib headers
+        self.decompressor = zlib.decompressobj(32 + zlib.MAX_WBITS) if encoding in ("gzip", "deflate") else None
+        self.started = False
+        self.text = codecs.getincrementaldecoder("utf-8")(errors="replace")
+
+    def decode(self, data: bytes, final: bool = False) -> str:
+        if self.decompressor is not None:
+            try:
+                data = self.decompressor.decompress(data)
+            except zlib.error:
+                if not self.deflate or self.started:
+                    raise
+                # deflate without the zlib header
+                self.decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+                data = self.decompressor.decompress(data)
+            self.started = True
+            if final:
+                data += self.decompressor.flush()
+        return self.text.decode(data, final)
@@ -3,11 +3,17 @@ from aiohttp import web, ClientTimeout
 import logging
 from urllib.parse import urlparse, urljoin, unquote
 import subprocess
-import json
-import base64
 import os
+import zlib
 import asyncio
 import re
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Optional
+from main.vars import Var
+from main.utils.metrics import deno_seconds
+from .deno_workers import DenoPool, DenoWorkerError, deno_command
+from .html_rewriter import BodyDecoder, HtmlRewriter, rewrite_html
 
 
 routes = web.RouteTableDef()
@@ -16,6 +22,32 @@ BASE_URL_FILM = "https://lk21.film"
 PROXY_PREFIX_FILM = "/film/"
 
 DENO_SCRIPT_PATH = os.path.join(os.path.dirname(__file__), 'proxy.ts')
+DENO_TIMEOUT = 60
+
+PROXY_CONNECTIONS = 100
+PROXY_CHUNK_SIZE = 64 * 1024
+# no total timeout, a video segment may take long, only stalls are cut
+PROXY_TIMEOUT = ClientTimeout(total=None, sock_connect=15, sock_read=60)
+HOP_BY_HOP_HEADERS = (
+    'connection', 'keep-alive', 'proxy-authenticate', 'proxy-authorization', 'proxy-connection',
+    'te', 'trailer', 'transfer-encoding', 'upgrade', 'host',
+)
+# pages at least this big are rewritten in HTML_REWRITE_WORKERS processes instead of the event loop
+HTML_OFFLOAD_SIZE = 256 * 1024
+
+deno_pool = DenoPool(
+    deno_command(DENO_SCRIPT_PATH), Var.DENO_WORKERS, Var.DENO_MAX_WORKERS, Var.DENO_WORKER_MAX_REQUESTS
+)
+html_pool: Optional[ProcessPoolExecutor] = None
+
+
+def get_html_pool() -> Optional[ProcessPoolExecutor]:
+    """The processes big pages are rewritten in, started on first use. None when HTML_REWRITE_WORKERS is 0."""
+    global html_pool
+    if html_pool is None and Var.HTML_REWRITE_WORKERS > 0:
+        html_pool = ProcessPoolExecutor(max_workers=Var.HTML_REWRITE_WORKERS)
+    return html_pool
+
 
 async def check_deno_and_script():
     try:
@@ -42,110 +74,168 @@ async def check_deno_and_script():
         logging.error(f"Unexpected error during Deno setup check: {e}")
 
 
-async def process_with_deno(request: web.Request, target_url: str):
-    method = request.method
-    request_headers = dict(request.headers)
-    request_body = await request.read()
-    request_body_str = request_body.decode('utf-8', errors='ignore')
+async def process_with_deno(target_url: str, html: str, status: int, headers: dict):
+    started = time.monotonic()
+    response = await run_deno(target_url, html, status, headers)
+    deno_seconds.observe(time.monotonic() - started, "ok" if response.status < 500 else "error")
+    return response
+
 
+async def run_deno(target_url: str, html: str, status: int, headers: dict):
+    """Rewrites the links of an HTML page fetched from BASE_URL_FILM in a Deno worker."""
     input_data = {
         'targetUrl': target_url,
         'baseUrl': BASE_URL_FILM,
-        'method': method,
-        'headers': request_headers,
-        'body': request_body_str if request_body else None,
         'proxyPrefix': PROXY_PREFIX_FILM,
+        'html': html,
+        'status': status,
+        'responseHeaders': headers,
     }
 
     try:
-        deno_command = [
-            'deno', 'run',
-            '-A',
-            DENO_SCRIPT_PATH
-        ]
-
-        process = await asyncio.create_subprocess_exec(
-            *deno_command,
-            stdin=subprocess.PIPE,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE
-        )
+        deno_output = await deno_pool.request(input_data, DENO_TIMEOUT)
+    except asyncio.TimeoutError:
+        logging.error(f"Deno worker timed out after {DENO_TIMEOUT} seconds for {target_url}")
+        return web.Response(status=504, text="Proxy Gateway Timeout: Deno script took too long.")
+    except DenoWorkerError as e:
+        logging.error(f"Deno worker failed for {target_url}: {e}")
+        return web.Response(status=500, text="Proxy Error: Deno worker failed.")
+    except FileNotFoundError:
+        logging.error("Deno command not found. Is Deno installed and in PATH?")
+        return web.Response(status=500, text="Proxy Error: Deno not found.")
+    except Exception as e:
+        logging.error(f"Error talking to the Deno workers for {target_url}: {e}")
+        return web.Response(status=500, text=f"Proxy Error: Deno worker setup failed: {e}")
+
+    proxy_response = web.Response(status=deno_output.get('status', 500))
+    for header, value in deno_output.get('headers', {}).items():
+        proxy_response.headers[header] = value
+    proxy_response.body = deno_output.get('body', '').encode('utf-8', errors='ignore')
+    return proxy_response
+
+
+def make_proxy_session() -> aiohttp.ClientSession:
+    """The pooled session every proxied request goes through.
+    Bodies are passed on compressed as they come, and no cookies are kept between viewers."""
+    return aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(limit=PROXY_CONNECTIONS, ttl_dns_cache=300),
+        cookie_jar=aiohttp.DummyCookieJar(),
+        auto_decompress=False,
+        timeout=PROXY_TIMEOUT,
+    )
+
+
+def upstream_headers(request: web.Request) -> dict:
+    headers = {
+        name: value for name, value in request.headers.items()
+        if name.lower() not in HOP_BY_HOP_HEADERS + ('accept-encoding',)
+    }
+    # only encodings the HTML pages can be decoded from
+    encodings = [e.strip() for e in request.headers.get('Accept-Encoding', '').split(',')]
+    accepted = [e for e in encodings if e.split(';')[0].strip().lower() in ('gzip', 'deflate')]
+    headers['Accept-Encoding'] = ', '.join(accepted) or 'identity'
+    return headers
 
-        try:
-            stdout_data, stderr_data = await asyncio.wait_for(
-                process.communicate(input=json.dumps(input_data).encode('utf-8')),
-                timeout=60
-            )
-        except asyncio.TimeoutError:
-            logging.error(f"Deno script timed out after 60 seconds for {target_url}")
-            process.kill()
-            await process.wait()
-            return web.Response(status=504, text="Proxy Gateway Timeout: Deno script took too long.")
-        except Exception as e:
-             logging.error(f"Error during Deno process communication for {target_url}: {e}")
-             if process.returncode is None:
-                 process.kill()
-                 await process.wait()
-             return web.Response(status=500, text=f"Proxy Error: Deno communication failed: {e}")
-
-        if process.returncode != 0:
-            stderr_output = stderr_data.decode('utf-8', errors='ignore')
-            logging.error(f"Deno script failed with exit code {process.returncode} for {target_url}")
-            logging.error(f"Deno Stderr:\n{stderr_output}")
-            try:
-                 partial_stdout = stdout_data.decode('utf-8', errors='ignore')
-                 logging.error(f"Deno partial Stdout:\n{partial_stdout}")
-            except Exception:
-                 pass
-            return web.Response(status=500, text=f"Proxy Error: Deno script failed (Code {process.returncode}).")
 
-        try:
-            deno_output_str = stdout_data.decode('utf-8').strip()
-            if not deno_output_str:
-                 logging.error(f"Deno script produced empty stdout for {target_url}. Stderr:\n{stderr_data.decode('utf-8', errors='ignore')}")
-                 return web.Response(status=500, text="Proxy Error: Deno script produced no output.")
-
-            deno_output = json.loads(deno_output_str)
-
-        except json.JSONDecodeError:
-             stderr_output = stderr_data.decode('utf-8', errors='ignore')
-             logging.error(f"Failed to decode JSON from Deno stdout for {target_url}:\n{stdout_data.decode('utf-8', errors='ignore')}")
-             logging.error(f"Deno Stderr:\n{stderr_output}")
-             return web.Response(status=500, text="Proxy Error: Invalid JSON response from Deno script.")
-        except Exception as e:
-             stderr_output = stderr_data.decode('utf-8', errors='ignore')
-             logging.error(f"Unexpected error processing Deno stdout for {target_url}: {e}")
-             logging.error(f"Deno Stderr:\n{stderr_output}")
-             return web.Response(status=500, text="Proxy Error: Failed to process Deno output.")
-
-        proxy_response = web.Response(status=deno_output.get('status', 500))
-
-        output_headers = deno_output.get('headers', {})
-        for header, value in output_headers.items():
-             proxy_response.headers[header] = value
-
-        output_body = deno_output.get('body', '')
-        if output_headers.get('X-Proxy-Body-Encoding') == 'base64':
-             try:
-                 proxy_response.body = base64.b64decode(output_body)
-                 del proxy_response.headers['X-Proxy-Body-Encoding']
-             except Exception as e:
-                 logging.error(f"Failed to decode base64 body from Deno for {target_url}: {e}")
-                 proxy_response.body = output_body.encode('utf-8', errors='ignore')
-                 if 'Content-Type' not in proxy_response.headers or proxy_response.headers['Content-Type'].lower().startswith('application/octet-stream'):
-                     proxy_response.headers['Content-Type'] = 'text/plain'
+def cut_off(request: web.Request) -> None:
+    """Closes the viewer's connection when a body breaks off after the headers were sent."""
+    # None once the viewer has gone
+    if request.transport is not None:
+        request.transport.close()
 
-        else:
-             proxy_response.body = output_body.encode('utf-8', errors='ignore')
 
-        return proxy_response
+async def read_page(upstream: aiohttp.ClientResponse) -> str:
+    decoder = BodyDecoder(upstream.headers.get('Content-Encoding', ''))
+    return decoder.decode(await upstream.read(), final=True)
 
-    except FileNotFoundError:
-        logging.error("Deno command not found. Is Deno installed and in PATH?")
-        return web.Response(status=500, text="Proxy Error: Deno not found.")
-    except Exception as e:
-        logging.error(f"Error executing Deno subprocess for {target_url}: {e}")
-        return web.Response(status=500, text=f"Proxy Error: Subprocess setup failed: {e}")
+
+async def rewrite_page(request: web.Request, upstream: aiohttp.ClientResponse, target_url: str, headers: dict):
+    """
+    Rewrites the links of an HTML page in-process. Most pages are rewritten while they arrive,
+    each piece is sent on as soon as it's done. Pages of HTML_OFFLOAD_SIZE or more are rewritten
+    whole in the worker processes, so they don't hold up the other streams.
+    """
+    pool = get_html_pool()
+    if pool is not None and (upstream.content_length or 0) >= HTML_OFFLOAD_SIZE:
+        try:
+            page = await read_page(upstream)
+        except (aiohttp.ClientError, asyncio.TimeoutError, zlib.error) as e:
+            logging.error(f"Failed reading the page {target_url}: {e!r}")
+            return web.Response(status=502, text=f"Proxy Error: {e!r}")
+        body = await asyncio.get_event_loop().run_in_executor(
+            pool, rewrite_html, page, target_url, BASE_URL_FILM, PROXY_PREFIX_FILM
+        )
+        return web.Response(status=upstream.status, body=body.encode('utf-8'), headers=headers)
+
+    decoder = BodyDecoder(upstream.headers.get('Content-Encoding', ''))
+    rewriter = HtmlRewriter(target_url, BASE_URL_FILM, PROXY_PREFIX_FILM)
+    response = web.StreamResponse(status=upstream.status, reason=upstream.reason, headers=headers)
+    await response.prepare(request)
+    try:
+        async for chunk in upstream.content.iter_chunked(PROXY_CHUNK_SIZE):
+            text = rewriter.feed(decoder.decode(chunk))
+            if text:
+                await response.write(text.encode('utf-8'))
+        text = rewriter.feed(decoder.decode(b'', final=True), final=True)
+    except (aiohttp.ClientError, asyncio.TimeoutError, zlib.error) as e:
+        logging.warning(f"Proxy stream from {target_url} broke off: {e!r}")
+        cut_off(request)
+        return response
+    await response.write(text.encode('utf-8'))
+    await response.write_eof()
+    return response
+
+
+async def proxy_film(request: web.Request, target_url: str):
+    """
+    Fetches a page through the pooled session. The links of HTML pages are rewritten
+    (by a Deno worker with HTML_REWRITER=deno), everything else (images, scripts, video segments, Range requests) is streamed straight through.
+    """
+    session: aiohttp.ClientSession = request.app['proxy_session']
+    try:
+        upstream = await session.request(
+            request.method,
+            target_url,
+            headers=upstream_headers(request),
+            data=request.content if request.body_exists else None,
+        )
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        logging.error(f"Proxy request to {target_url} failed: {e!r}")
+        return web.Response(status=502, text=f"Proxy Error: {e!r}")
+
+    async with upstream:
+        content_type = upstream.headers.get('Content-Type', '')
+        # only pages with a body are rewritten, a 304 or 204 must go out without one
+        bodied = 200 <= upstream.status < 300 and upstream.status not in (204, 205)
+        if 'text/html' in content_type and bodied and request.method != 'HEAD':
+            headers = {
+                name: value for name, value in upstream.headers.items()
+                if name.lower() not in HOP_BY_HOP_HEADERS + ('content-encoding', 'content-length', 'set-cookie')
+            }
+            if Var.HTML_REWRITER != 'deno':
+                return await rewrite_page(request, upstream, target_url, headers)
+            try:
+                page = await read_page(upstream)
+            except (aiohttp.ClientError, asyncio.TimeoutError, zlib.error) as e:
+                logging.error(f"Failed reading the page {target_url}: {e!r}")
+                return web.Response(status=502, text=f"Proxy Error: {e!r}")
+            return await process_with_deno(target_url, page, upstream.status, headers)
+
+        response = web.StreamResponse(status=upstream.status, reason=upstream.reason)
+        for name, value in upstream.headers.items():
+            if name.lower() not in HOP_BY_HOP_HEADERS + ('set-cookie',):
+                response.headers.add(name, value)
+        await response.prepare(request)
+        try:
+            async for chunk in upstream.content.iter_chunked(PROXY_CHUNK_SIZE):
+                await response.write(chunk)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            # the headers are out already, all that's left is cutting the connection
+            logging.warning(f"Proxy stream from {target_url} broke off: {e!r}")
+            cut_off(request)
+            return response
+        await response.write_eof()
+        return response
 
 
 @routes.route('*', PROXY_PREFIX_FILM + '{path:.*}')
@@ -157,6 +247,6 @@ async def film_proxy_handler(request: web.Request):
         target_url = BASE_URL_FILM
 
     target_url = unquote(target_url)
-    logging.info(f"Proxying /film/ request to Deno for: {target_url}")
+    logging.info(f"Proxying /film/ request for: {target_url}")
 
-    return await process_with_deno(request, target_url)
+    return await proxy_film(request, target_url)
@@ -1,85 +1,84 @@
 
 import { manipulateHtml } from './parsing.ts';
 
-async function readAllManual(reader: Deno.Reader): Promise<Uint8Array> {
-  const chunks: Uint8Array[] = [];
-  const buf = new Uint8Array(4096);
-  while (true) {
-    const nread = await reader.read(buf);
-    if (nread === null) {
-      break;
-    }
-    chunks.push(buf.slice(0, nread));
-  }
-  const totalLength = chunks.reduce((sum, chunk) => sum + chunk.length, 0);
-  const result = new Uint8Array(totalLength);
-  let offset = 0;
-  for (const chunk of chunks) {
-    result.set(chunk, offset);
-    offset += chunk.length;
-  }
-  return result;
-}
+// The server fetches the page itself and only sends HTML to be rewritten,
+// so a request always carries the page with the status and headers to answer with.
+async function handleRequest(requestData: any) {
+  const { targetUrl, baseUrl, proxyPrefix, html } = requestData;
 
-async function processRequest() {
+  const decodedTargetUrl = decodeURIComponent(targetUrl);
+  let outputBody = html;
   try {
-    const inputBytes = await readAllManual(Deno.stdin);
-    const inputJsonString = new TextDecoder().decode(inputBytes);
-    const requestData = JSON.parse(inputJsonString);
-
-    const { targetUrl, baseUrl, method, headers, body, proxyPrefix } = requestData;
-
-    const decodedTargetUrl = decodeURIComponent(targetUrl);
+    outputBody = manipulateHtml(html, decodedTargetUrl, baseUrl, proxyPrefix);
+  } catch (e) {
+    console.error("Error processing HTML:", e);
+  }
+  return { status: requestData.status, headers: requestData.responseHeaders, body: outputBody };
+}
 
-    const response = await fetch(decodedTargetUrl, {
-      method: method,
-      headers: headers,
-      body: typeof body === 'string' ? body : undefined,
-    });
+function errorOutput(e: any) {
+  return {
+    status: 500,
+    headers: { 'Content-Type': 'text/plain' },
+    body: `Deno Proxy Error: ${e.message || String(e)}`,
+  };
+}
 
-    const outputHeaders: Record<string, string> = {};
-    response.headers.forEach((value, name) => {
-      const lowerName = name.toLowerCase();
-      if (!['content-encoding', 'connection', 'transfer-encoding', 'content-length', 'set-cookie'].includes(lowerName)) {
-        outputHeaders[name] = value;
-      }
-    });
+async function writeAll(data: Uint8Array) {
+  let written = 0;
+  while (written < data.length) {
+    written += await Deno.stdout.write(data.subarray(written));
+  }
+}
 
-    let outputBody: string;
-    const contentType = response.headers.get('content-type') || '';
+// Started with --serve by the web server: many requests over stdin/stdout until stdin is closed.
+// Every message is a 4 byte big-endian length followed by that much JSON; requests
+// carry an `id` that their response repeats, so they are handled concurrently.
+async function serve() {
+  const reader = Deno.stdin.readable.getReader();
+  const encoder = new TextEncoder();
+  const decoder = new TextDecoder();
+  const pending = new Set<Promise<void>>();
+  let writing = Promise.resolve();
+  let buffer = new Uint8Array(0);
 
-    if (contentType.includes('text/html') && response.status < 400) {
-      const html = await response.text();
-      try {
-        outputBody = manipulateHtml(html, decodedTargetUrl, baseUrl, proxyPrefix);
+  const send = (message: unknown) => {
+    const payload = encoder.encode(JSON.stringify(message));
+    const frame = new Uint8Array(4 + payload.length);
+    new DataView(frame.buffer).setUint32(0, payload.length);
+    frame.set(payload, 4);
+    writing = writing.then(() => writeAll(frame));
+    return writing;
+  };
 
-      } catch (e) {
-        console.error("Error processing HTML:", e);
-        outputBody = html;
+  while (true) {
+    while (buffer.length >= 4) {
+      const length = new DataView(buffer.buffer, buffer.byteOffset).getUint32(0);
+      if (buffer.length < 4 + length) {
+        break;
       }
-    } else {
-      const buffer = await response.arrayBuffer();
-      outputBody = btoa(String.fromCharCode(...new Uint8Array(buffer)));
-      outputHeaders['X-Proxy-Body-Encoding'] = 'base64';
+      const requestData = JSON.parse(decoder.decode(buffer.subarray(4, 4 + length)));
+      buffer = buffer.slice(4 + length);
+      const handled = handleRequest(requestData)
+        .catch((e) => {
+          console.error("Error in Deno worker:", e);
+          return errorOutput(e);
+        })
+        .then((output) => send({ id: requestData.id, ...output }));
+      pending.add(handled);
+      handled.finally(() => pending.delete(handled));
     }
-
-    const output = {
-      status: response.status,
-      headers: outputHeaders,
-      body: outputBody,
-    };
-
-    console.log(JSON.stringify(output));
-
-  } catch (e) {
-    console.error("Error in Deno script:", e);
-    console.log(JSON.stringify({
-      status: 500,
-      headers: { 'Content-Type': 'text/plain' },
-      body: `Deno Proxy Error: ${e.message || String(e)}`,
-    }));
-     Deno.exit(1);
+    const { value, done } = await reader.read();
+    if (done) {
+      break;
+    }
+    const joined = new Uint8Array(buffer.length + value.length);
+    joined.set(buffer);
+    joined.set(value, buffer.length);
+    buffer = joined;
   }
+  await Promise.all(pending);
+  await writing;
 }
 
-processRequest();
+await serve();
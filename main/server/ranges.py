@@ -0,0 +1,142 @@
+# This file is a part of TG-Direct-Link-Generator
+
+import re
+import secrets
+from datetime import datetime, timezone
+from email.utils import format_datetime, parsedate_to_datetime
+from typing import List, Optional, Tuple
+from aiohttp import web
+
+# more ranges than this (after merging) are answered with the whole file
+MAX_RANGES = 16
+# telegram files never change, so whatever is in front of us may keep them forever
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+_RANGE_SPEC = re.compile(r"^\s*(\d*)\s*-\s*(\d*)\s*$")
+
+
+def parse_range(header: Optional[str], file_size: int) -> Optional[List[Tuple[int, int]]]:
+    """
+    Returns the (first, last) byte ranges of a Range header, sorted and merged.
+    Returns None when the whole file should be served: no header, another unit or a malformed header.
+    Raises HTTPRequestRangeNotSatisfiable when none of the ranges is inside the file.
+    """
+    if not header:
+        return None
+    unit, _, specs = header.partition("=")
+    if unit.strip().lower() != "bytes" or not specs:
+        return None
+    ranges = []
+    for spec in specs.split(","):
+        match = _RANGE_SPEC.match(spec)
+        if not match or not any(match.groups()):
+            return None
+        first, last = match.groups()
+        if not first:
+            # a suffix range: the last N bytes
+            length = int(last)
+            if length == 0 or file_size == 0:
+                continue
+            ranges.append((max(0, file_size - length), file_size - 1))
+            continue
+        first = int(first)
+        if last and first > int(last):
+            return None
+        if first < file_size:
+            ranges.append((first, min(int(last), file_size - 1) if last else file_size - 1))
+    if not ranges:
+        raise web.HTTPRequestRangeNotSatisfiable(headers={"Content-Range": f"bytes */{file_size}"})
+    ranges.sort()
+    merged = [ranges[0]]
+    for first, last in ranges[1:]:
+        if first <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], last))
+        else:
+            merged.append((first, last))
+    if len(merged) > MAX_RANGES:
+        return None
+    return merged
+
+
+def make_etag(unique_id: str) -> str:
+    """
+    Returns the strong ETag of a file, its file_unique_id is the same for the same bytes.
+    """
+    return f'"{unique_id}"'
+
+
+def http_date(timestamp: int) -> str:
+    return format_datetime(datetime.fromtimestamp(timestamp, timezone.utc), usegmt=True)
+
+
+def _parse_http_date(value: str) -> Optional[int]:
+    try:
+        return int(parsedate_to_datetime(value).timestamp())
+    except (TypeError, ValueError, IndexError):
+        return None
+
+
+def _etags(header: str) -> List[str]:
+    return [tag.strip() for tag in header.split(",") if tag.strip()]
+
+
+def is_not_modified(request: web.BaseRequest, etag: str, last_modified: int) -> bool:
+    """
+    Evaluates If-None-Match, or If-Modified-Since when there's no If-None-Match.
+    """
+    if_none_match = request.headers.get("If-None-Match")
+    if if_none_match is not None:
+        # the weak comparison: W/ prefixes don't matter here
+        tags = [tag[2:] if tag.startswith("W/") else tag for tag in _etags(if_none_match)]
+        return "*" in tags or etag in tags
+    if_modified_since = request.headers.get("If-Modified-Since")
+    if if_modified_since is not None and last_modified:
+        since = _parse_http_date(if_modified_since)
+        return since is not None and last_modified <= since
+    return False
+
+
+def if_range_matches(request: web.BaseRequest, etag: str, last_modified: int) -> bool:
+    """
+    Returns whether the Range header may be used: there's no If-Range,
+    or it holds the current strong ETag or exact Last-Modified date.
+    """
+    if_range = request.headers.get("If-Range")
+    if if_range is None:
+        return True
+    if_range = if_range.strip()
+    if if_range.startswith('"') or if_range.startswith("W/"):
+        return if_range == etag
+    return bool(last_modified) and _parse_http_date(if_range) == last_modified
+
+
+class MultipartRanges:
+    def __init__(self, ranges: List[Tuple[int, int]], file_size: int, content_type: str):
+        """The framing of a multipart/byteranges response.
+        attributes:
+            boundary: the separator between the parts.
+            content_type: the Content-Type of the whole response.
+            content_length: the exact length of the whole response, parts included.
+
+        functions:
+            part_header: returns the bytes sent before the part of a range.
+            closing: returns the bytes that end the response.
+        """
+        self.ranges = ranges
+        self.file_size = file_size
+        self.part_type = content_type
+        self.boundary = secrets.token_hex(16)
+        self.content_type = f"multipart/byteranges; boundary={self.boundary}"
+        self.content_length = len(self.closing()) + sum(
+            len(self.part_header(first, last)) + last - first + 1 for first, last in ranges
+        )
+
+    def part_header(self, first: int, last: int) -> bytes:
+        return (
+            f"\r\n--{self.boundary}\r\n"
+            f"Content-Type: {self.part_type}\r\n"
+            f"Content-Range: bytes {first}-{last}/{self.file_size}\r\n\r\n"
+        ).encode()
+
+    def closing(self) -> bytes:
+        return f"\r\n--{self.boundary}--\r\n".encode()
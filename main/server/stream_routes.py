@@ -1,17 +1,33 @@
 # File: stream_routes.py
 import re
 import time
-import math
+import asyncio
+import weakref
+import hashlib
 import logging
 import secrets
 import mimetypes
+from functools import partial
 from aiohttp import web
 from aiohttp.http_exceptions import BadStatusLine
-from main.bot import multi_clients, work_loads
+from main.bot import StreamBot, multi_clients, work_loads
 from main.server.exceptions import FIleNotFound, InvalidHash
-from main import Var, utils, StartTime, __version__, StreamBot
+from main import Var, utils, StartTime, __version__
 from main.utils.render_template import render_page
-from .prox import process_with_deno, BASE_URL_FILM, PROXY_PREFIX_FILM
+from main.utils.media_sessions import warmup_status
+from main.utils.metadata import file_metadata
+from main.utils.scheduler import scheduler
+from main.utils.chunk_cache import ChunkFileResponse, chunk_key, disk_cache, memory_cache
+from main.utils.mp4 import mp4_layouts
+from main.utils.hls import hls_indexes
+from main.utils.metrics import Gauge, register, render_metrics
+from main.utils.custom_dl import chunk_fetches
+from main.utils.shaping import shaper
+from .ranges import (
+    IMMUTABLE_CACHE_CONTROL, MultipartRanges, http_date, if_range_matches, is_not_modified,
+    make_etag, parse_range,
+)
+from .prox import proxy_film, BASE_URL_FILM, PROXY_PREFIX_FILM
 from urllib.parse import urljoin
 
 
@@ -28,7 +44,9 @@ async def root_route_handler(_):
         {
             "server_status": "running",
             "uptime": utils.get_readable_time(time.time() - StartTime),
-            "telegram_bot": "@" + StreamBot.username,
+            # only worker 0 runs the main bot when there are several workers
+            "telegram_bot": "@" + StreamBot.username if StreamBot.is_connected else None,
+            "worker": Var.WORKER_INDEX,
             "connected_bots": len(multi_clients),
             "loads": dict(
                 ("bot" + str(c + 1), l)
@@ -36,10 +54,35 @@ async def root_route_handler(_):
                     sorted(work_loads.items(), key=lambda x: x[1], reverse=True)
                 )
             ),
+            "memory_cache": memory_cache.stats(),
+            "media_session_warmup": warmup_status,
+            "scheduler": scheduler.describe(),
+            "shaping": shaper.describe(),
             "version": __version__,
         }
     )
 
+register(Gauge("tg_active_streams", "Streams every client is serving.", ["client"],
+               lambda: {(index,): load for index, load in work_loads.items()}))
+register(Gauge("tg_chunk_cache_hits_total", "Chunk requests answered from a cache.", ["cache"],
+               lambda: {("memory",): memory_cache.hits, ("disk",): disk_cache.hits}, kind="counter"))
+register(Gauge("tg_chunk_cache_misses_total", "Chunk requests a cache couldn't answer.", ["cache"],
+               lambda: {("memory",): memory_cache.misses, ("disk",): disk_cache.misses}, kind="counter"))
+register(Gauge("tg_chunk_fetches_shared_total", "Chunk requests that joined a fetch already in flight.", [],
+               lambda: {(): chunk_fetches.shared}, kind="counter"))
+
+
+# every worker only reports its own streams, clients and caches; the worker label keeps their series apart
+METRICS_LABELS = (("worker", str(Var.WORKER_INDEX)),) if Var.WORKER_INDEX >= 0 else ()
+
+
+@routes.get("/metrics")
+async def metrics_handler(_):
+    return web.Response(
+        body=render_metrics(METRICS_LABELS).encode(),
+        headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"},
+    )
+
 @routes.get(r"/watch/{path:\S+}", allow_head=True)
 async def stream_handler_watch(request: web.Request):
     try:
@@ -56,8 +99,16 @@ async def stream_handler_watch(request: web.Request):
             secure_hash = request.rel_url.query.get("hash")
 
         html_content = await render_page(message_id, secure_hash)
-        return web.Response(text=html_content, content_type='text/html')
-
+        etag = make_etag(hashlib.blake2b(html_content.encode(), digest_size=16).hexdigest())
+        if is_not_modified(request, etag, 0):
+            raise web.HTTPNotModified(headers={"ETag": etag})
+        response = web.Response(text=html_content, content_type='text/html')
+        response.headers["ETag"] = etag
+        response.headers["Cache-Control"] = "no-cache"
+        return response
+
+    except web.HTTPException:
+        raise
     except InvalidHash as e:
         logging.warning(f"Invalid hash: {e.message}")
         raise web.HTTPForbidden(text=e.message)
@@ -71,6 +122,89 @@ async def stream_handler_watch(request: web.Request):
         logging.critical(f"Unexpected error in stream_handler_watch: {e}", exc_info=True)
         raise web.HTTPInternalServerError(text=f"An unexpected server error occurred: {str(e)}")
 
+@routes.get(r"/hls/{path:\S+}", allow_head=True)
+async def hls_playlist_handler(request: web.Request):
+    try:
+        path = request.match_info["path"]
+        match = re.search(r"^([a-zA-Z0-9_-]{6})(\d+)\.m3u8$", path)
+        if not match:
+            raise web.HTTPNotFound(text="Invalid playlist path")
+        secure_hash = match.group(1)
+        message_id = int(match.group(2))
+
+        file_id = file_metadata.get(message_id)
+        if file_id is None:
+            file_id = await get_byte_streamer(scheduler.pick()).get_file_properties(message_id)
+        if file_id.unique_id[:6] != secure_hash:
+            raise InvalidHash("Invalid file hash provided.")
+
+        etag = make_etag(f"{file_id.unique_id}-hls")
+        headers = {"ETag": etag, "Cache-Control": IMMUTABLE_CACHE_CONTROL}
+        if is_not_modified(request, etag, 0):
+            raise web.HTTPNotModified(headers=headers)
+        index = await hls_indexes.get(get_byte_streamer(scheduler.pick(file_id.dc_id)), file_id)
+        if index is None:
+            raise web.HTTPNotFound(text="This file can't be streamed with HLS")
+        # the segments are byte ranges of the download link, served by media_streamer
+        return web.Response(
+            text=index.playlist(f"../{secure_hash}{message_id}"),
+            content_type="application/vnd.apple.mpegurl",
+            headers=headers,
+        )
+
+    except web.HTTPException:
+        raise
+    except InvalidHash as e:
+        logging.warning(f"Invalid hash: {e.message}")
+        raise web.HTTPForbidden(text=e.message)
+    except FIleNotFound as e:
+        logging.warning(f"File not found: {e.message}")
+        raise web.HTTPNotFound(text=e.message)
+    except Exception as e:
+        logging.critical(f"Unexpected error in hls_playlist_handler: {e}", exc_info=True)
+        raise web.HTTPInternalServerError(text=f"An unexpected server error occurred: {str(e)}")
+
+@routes.get(r"/thumb/{path:\S+}", allow_head=True)
+async def thumbnail_handler(request: web.Request):
+    try:
+        path = request.match_info["path"]
+        match = re.search(r"^([a-zA-Z0-9_-]{6})(\d+)(?:\.\w+)?$", path)
+        if not match:
+            raise web.HTTPNotFound(text="Invalid thumbnail path")
+        secure_hash = match.group(1)
+        message_id = int(match.group(2))
+
+        file_id = file_metadata.get(message_id)
+        if file_id is None:
+            file_id = await get_byte_streamer(scheduler.pick()).get_file_properties(message_id)
+        if file_id.unique_id[:6] != secure_hash:
+            raise InvalidHash("Invalid file hash provided.")
+        if not getattr(file_id, "thumb_size", ""):
+            raise web.HTTPNotFound(text="This file has no thumbnail")
+
+        etag = make_etag(f"{file_id.unique_id}-{file_id.thumb_size}")
+        headers = {"ETag": etag, "Cache-Control": IMMUTABLE_CACHE_CONTROL}
+        if is_not_modified(request, etag, 0):
+            raise web.HTTPNotModified(headers=headers)
+        # served from the chunk caches after the first request
+        thumbnail = await get_byte_streamer(scheduler.pick(file_id.dc_id)).get_thumbnail(file_id)
+        if thumbnail is None:
+            raise web.HTTPNotFound(text="This file has no thumbnail")
+        content_type = "image/webp" if thumbnail[8:12] == b"WEBP" else "image/jpeg"
+        return web.Response(body=thumbnail, content_type=content_type, headers=headers)
+
+    except web.HTTPException:
+        raise
+    except InvalidHash as e:
+        logging.warning(f"Invalid hash: {e.message}")
+        raise web.HTTPForbidden(text=e.message)
+    except FIleNotFound as e:
+        logging.warning(f"File not found: {e.message}")
+        raise web.HTTPNotFound(text=e.message)
+    except Exception as e:
+        logging.critical(f"Unexpected error in thumbnail_handler: {e}", exc_info=True)
+        raise web.HTTPInternalServerError(text=f"An unexpected server error occurred: {str(e)}")
+
 @routes.get(r"/{path:\S+}", allow_head=True)
 async def stream_handler_download(request: web.Request):
     requested_path = request.match_info["path"]
@@ -107,8 +241,10 @@ async def stream_handler_download(request: web.Request):
 
         # Jika parsing berhasil (tidak ada StreamParsingFailed yang dinaikkan), panggil media_streamer.
         # media_streamer bisa melempar InvalidHash (hash mismatch) atau FIleNotFound saat validasi lebih lanjut.
-        return await media_streamer(request, message_id, secure_hash)
+        return await media_streamer(request, message_id, secure_hash, playback=bool(match_hash_id))
 
+    except web.HTTPException:
+        raise
     # --- Penanganan Exception: Jika Parsing Stream Gagal ATAU Error Saat Streaming ---
     # Menangkap StreamParsingFailed ATAU exception yang mungkin dilempar oleh media_streamer
     # saat mencoba mendapatkan properti file (InvalidHash, FIleNotFound, error koneksi, ValueError dari int(), dll.)
@@ -117,9 +253,9 @@ async def stream_handler_download(request: web.Request):
         # Konstruksi target URL untuk domain asli
         target_url = urljoin(BASE_URL_FILM, requested_path)
         # Panggil fungsi pemrosesan proxy dari prox.py
-        # Tangkap exception yang mungkin muncul dari process_with_deno sebagai internal error server
+        # Tangkap exception yang mungkin muncul dari proxy_film sebagai internal error server
         try:
-             return await process_with_deno(request, target_url)
+             return await proxy_film(request, target_url)
         except Exception as proxy_e:
              logging.error(f"Error during proxy processing after stream handling failed for /{requested_path}: {proxy_e}", exc_info=True)
              # Kembalikan 500 jika bahkan fallback proxy pun gagal
@@ -136,63 +272,61 @@ async def stream_handler_download(request: web.Request):
 
 class_cache = {}
 
-async def media_streamer(request: web.Request, message_id: int, secure_hash: str):
-    range_header = request.headers.get("Range", None)
-
-    index = min(work_loads, key=work_loads.get)
-    faster_client = multi_clients[index]
-
-    if Var.MULTI_CLIENT:
-        logging.info(f"Client {index} is now serving {request.remote}")
-
-    if faster_client in class_cache:
-        tg_connect = class_cache[faster_client]
+def get_byte_streamer(index: int) -> utils.ByteStreamer:
+    client = multi_clients[index]
+    if client in class_cache:
         logging.debug(f"Using cached ByteStreamer object for client {index}")
-    else:
-        logging.debug(f"Creating new ByteStreamer object for client {index}")
-        tg_connect = utils.ByteStreamer(faster_client)
-        class_cache[faster_client] = tg_connect
+        return class_cache[client]
+    logging.debug(f"Creating new ByteStreamer object for client {index}")
+    tg_connect = utils.ByteStreamer(client)
+    class_cache[client] = tg_connect
+    return tg_connect
+
+def get_stripes(index: int, part_count: int) -> list:
+    """Picks the idle clients that share the parts of a download with client `index`.
+    Returns an empty list (single-client mode) when striping is off or the pool is busy."""
+    if not Var.STRIPED_STREAMING or part_count < 2:
+        return []
+    if work_loads[index] >= Var.STRIPE_MAX_LOAD:
+        return []
+    idle = [i for i, load in work_loads.items() if i != index and load < Var.STRIPE_MAX_LOAD]
+    return [(i, get_byte_streamer(i)) for i in idle[:part_count - 1]]
+
+async def media_streamer(request: web.Request, message_id: int, secure_hash: str, playback: bool):
+    range_header = request.headers.get("Range", None)
 
     logging.debug("before calling get_file_properties")
-    file_id = await tg_connect.get_file_properties(message_id)
+    file_id = file_metadata.get(message_id)
+    if file_id is None:
+        file_id = await get_byte_streamer(scheduler.pick()).get_file_properties(message_id)
     logging.debug("after calling get_file_properties")
 
     if file_id.unique_id[:6] != secure_hash:
         logging.debug(f"Invalid hash '{secure_hash}' for message with ID {message_id}. Expected '{file_id.unique_id[:6]}'")
         raise InvalidHash("Invalid file hash provided.")
 
-    file_size = file_id.file_size
-
-    if range_header:
-        try:
-            from_bytes, until_bytes = range_header.replace("bytes=", "").split("-")
-            from_bytes = int(from_bytes)
-            until_bytes = int(until_bytes) if until_bytes else file_size - 1
-            if from_bytes < 0 or until_bytes >= file_size or from_bytes > until_bytes:
-                logging.warning(f"Invalid Range header: {range_header}. File size: {file_size}")
-                raise web.HTTPBadRequest(text="Invalid Range header")
-
-        except ValueError:
-            logging.warning(f"Malformed Range header: {range_header}")
-            raise web.HTTPBadRequest(text="Malformed Range header")
-    else:
-        from_bytes = 0
-        until_bytes = file_size - 1
-
-    req_length = until_bytes - from_bytes + 1
-
-    new_chunk_size = await utils.chunk_size(req_length)
-    offset = await utils.offset_fix(from_bytes, new_chunk_size)
-    first_part_cut = from_bytes - offset
-    last_part_cut = (until_bytes + 1) % new_chunk_size
-    if last_part_cut == 0:
-        last_part_cut = new_chunk_size
-
-    part_count = math.ceil(req_length / new_chunk_size)
-
-    body = tg_connect.yield_file(
-        file_id, index, offset, first_part_cut, last_part_cut, part_count, new_chunk_size
-    )
+    # MP4s with moov at the end are played with it moved to the front, downloads get the file as uploaded.
+    # Every response of a file, HEADs and If-Range included, uses the same layout, read once and kept
+    rearrange = playback and mp4_layouts.enabled
+    last_modified = getattr(file_id, "date", 0)
+    if rearrange and mp4_layouts.uninspected(file_id):
+        # a revalidation needs no layout: the viewer holds one of the two representations
+        for candidate in (file_validators(file_id, None, last_modified), file_validators(file_id, True, last_modified)):
+            if is_not_modified(request, candidate["ETag"], last_modified):
+                raise web.HTTPNotModified(headers=candidate)
+
+    layout = None
+    if rearrange:
+        layout = await mp4_layouts.get(get_byte_streamer(scheduler.pick(file_id.dc_id)), file_id)
+    validators = file_validators(file_id, layout, last_modified)
+    if is_not_modified(request, validators["ETag"], last_modified):
+        raise web.HTTPNotModified(headers=validators)
+    file_size = layout.size if layout else file_id.file_size
+    etag = validators["ETag"]
+
+    ranges = None
+    if if_range_matches(request, etag, last_modified):
+        ranges = parse_range(range_header, file_size)
 
     mime_type = file_id.mime_type
     file_name = file_id.file_name
@@ -214,21 +348,184 @@ async def media_streamer(request: web.Request, message_id: int, secure_hash: str
                 file_name = f"{secrets.token_hex(4)}.unknown"
 
 
-    if "video/" in mime_type or "audio/" in mime_type:
+    # the player's links are played in the browser, the bot's download links are saved
+    if playback and ("video/" in mime_type or "audio/" in mime_type):
         disposition = "inline"
 
+    headers = {
+        "Content-Type": mime_type,
+        "Content-Disposition": f'{disposition}; filename="{file_name}"',
+        "Accept-Ranges": "bytes",
+        **validators,
+    }
+
+    if ranges is not None and len(ranges) > 1:
+        multipart = MultipartRanges(ranges, file_size, mime_type)
+        headers["Content-Type"] = multipart.content_type
+        headers["Content-Length"] = str(multipart.content_length)
+        if request.method == "HEAD":
+            return web.Response(status=206, headers=headers)
+        lease = open_lease(request, message_id)
+        index, tg_connect = pick_streamer(file_id, request.remote)
+        logging.debug(f"Returning {len(ranges)} ranges of {file_size} bytes as multipart/byteranges")
+        return web.Response(
+            status=206,
+            body=shaped(yield_multipart(tg_connect, file_id, index, multipart, layout), lease),
+            headers=headers,
+        )
+
+    from_bytes, until_bytes = ranges[0] if ranges else (0, file_size - 1)
+    req_length = until_bytes - from_bytes + 1
+    headers["Content-Length"] = str(req_length)
+    if ranges:
+        headers["Content-Range"] = f"bytes {from_bytes}-{until_bytes}/{file_size}"
+
+    # HEADs don't stream any bytes, a played MP4 only has its layout read once above. A GET needs the
+    # bytes, even a probe like bytes=0-0: from the caches below when they have them, from a client otherwise
+    if request.method == "HEAD":
+        return web.Response(status=206 if ranges else 200, headers=headers)
+    if layout:
+        lease = open_lease(request, message_id)
+        index, tg_connect = pick_streamer(file_id, request.remote)
+        return web.Response(
+            status=206 if ranges else 200,
+            body=shaped(yield_range(tg_connect, file_id, index, from_bytes, until_bytes, layout, request.remote), lease),
+            headers=headers,
+        )
+    cached = await cached_range(file_id, from_bytes, until_bytes)
+    if cached is not None:
+        logging.debug(f"Serving range {from_bytes}-{until_bytes} from the memory cache")
+        return web.Response(status=206 if ranges else 200, body=cached, headers=headers)
+
+    cache_key = chunk_key(file_id)
+    pieces = disk_cache.lookup(cache_key, from_bytes, until_bytes, file_size)
+    if pieces is not None:
+        logging.debug(f"Serving range {from_bytes}-{until_bytes} of {cache_key} from the disk cache")
+        return ChunkFileResponse(
+            pieces,
+            partial(disk_cache.release, cache_key, from_bytes, until_bytes),
+            status=206 if ranges else 200,
+            headers=headers,
+        )
+
+    lease = open_lease(request, message_id)
+    index, tg_connect = pick_streamer(file_id, request.remote)
     return_resp = web.Response(
-        status=206 if range_header else 200,
-        body=body,
-        headers={
-            "Content-Type": mime_type,
-            "Content-Range": f"bytes {from_bytes}-{until_bytes}/{file_size}",
-            "Content-Disposition": f'{disposition}; filename="{file_name}"',
-            "Accept-Ranges": "bytes",
-            "Content-Length": str(req_length),
-        },
+        status=206 if ranges else 200,
+        body=shaped(await stream_range(tg_connect, file_id, index, from_bytes, until_bytes, request.remote), lease),
+        headers=headers,
     )
 
     logging.debug(f"Returning response with status {return_resp.status}, range: {from_bytes}-{until_bytes}/{file_size}, filename: {file_name}")
 
     return return_resp
+
+def file_validators(file_id, layout, last_modified: int) -> dict:
+    """The ETag, Last-Modified and Cache-Control of a file, served as is or rearranged by `layout`."""
+    validators = {
+        "ETag": make_etag(f"{file_id.unique_id}-faststart" if layout else file_id.unique_id),
+        "Cache-Control": IMMUTABLE_CACHE_CONTROL,
+    }
+    if last_modified:
+        validators["Last-Modified"] = http_date(last_modified)
+    return validators
+
+def client_ip(request: web.Request) -> str:
+    """The viewer's IP: the last X-Forwarded-For entry (the one our proxy added) when proxy headers are trusted."""
+    if Var.TRUST_PROXY_HEADERS:
+        forwarded = request.headers.get("X-Forwarded-For")
+        if forwarded:
+            return forwarded.rsplit(",", 1)[-1].strip()
+    return request.remote
+
+def open_lease(request: web.Request, message_id: int):
+    """Lets a telegram-backed stream through the per-IP and per-link caps, answers 429 when one is reached.
+    Ranges served from the caches don't use a client and aren't counted."""
+    if not shaper.enabled:
+        return None
+    ip = client_ip(request)
+    lease = shaper.open(ip, message_id)
+    if lease is None:
+        logging.info(f"Refusing another stream of {message_id} to {ip}")
+        raise web.HTTPTooManyRequests(headers={"Retry-After": "1"})
+    return lease
+
+def shaped(body, lease):
+    """Sends a stream body at the rate its lease allows and frees the lease when it ends."""
+    if lease is None:
+        return body
+    shaped_body = yield_shaped(body, lease)
+    # a body that is never started (the viewer left before it) doesn't run its finally
+    weakref.finalize(shaped_body, lease.release)
+    return shaped_body
+
+async def yield_shaped(body, lease):
+    try:
+        async for chunk in body:
+            delay = lease.consume(len(chunk))
+            if delay:
+                await asyncio.sleep(delay)
+            yield chunk
+    finally:
+        lease.release()
+
+def pick_streamer(file_id, remote: str):
+    """Picks the client that streams the file and returns it with its ByteStreamer."""
+    index = scheduler.pick(file_id.dc_id)
+    if Var.MULTI_CLIENT:
+        logging.info(f"Client {index} is now serving {remote}")
+    return index, get_byte_streamer(index)
+
+async def cached_range(file_id, from_bytes: int, until_bytes: int):
+    """Returns the bytes of a range that fits in one chunk, if that chunk is in the memory cache."""
+    req_length = until_bytes - from_bytes + 1
+    new_chunk_size = await utils.chunk_size(req_length)
+    offset = await utils.offset_fix(from_bytes, new_chunk_size)
+    if until_bytes >= offset + new_chunk_size:
+        return None
+    chunk = memory_cache.get(chunk_key(file_id), offset, new_chunk_size)
+    if chunk is None:
+        return None
+    return chunk[from_bytes - offset:until_bytes - offset + 1]
+
+async def stream_range(tg_connect: utils.ByteStreamer, file_id, index: int, from_bytes: int, until_bytes: int, remote: str = None):
+    """Returns the generator that yields bytes `from_bytes` to `until_bytes` (inclusive) of the file."""
+    req_length = until_bytes - from_bytes + 1
+    new_chunk_size = await utils.chunk_size(req_length)
+    offset = await utils.offset_fix(from_bytes, new_chunk_size)
+    first_part_cut = from_bytes - offset
+    last_part_cut = (until_bytes + 1) % new_chunk_size
+    if last_part_cut == 0:
+        last_part_cut = new_chunk_size
+
+    # the parts a range touches, it may start and end in the middle of one
+    part_count = until_bytes // new_chunk_size - offset // new_chunk_size + 1
+
+    stripes = get_stripes(index, part_count)
+    if stripes:
+        logging.info(f"Striping {remote}'s download over clients {[index] + [i for i, _ in stripes]}")
+
+    return tg_connect.yield_file(
+        file_id, index, offset, first_part_cut, last_part_cut, part_count, new_chunk_size, stripes
+    )
+
+async def yield_range(tg_connect: utils.ByteStreamer, file_id, index: int, from_bytes: int, until_bytes: int, layout=None, remote: str = None):
+    """Yields bytes `from_bytes` to `until_bytes` of the file as it's served,
+    mapping them to the original file when it's served in a faststart layout."""
+    pieces = layout.map_range(from_bytes, until_bytes) if layout else [(from_bytes, until_bytes, None)]
+    for first, last, data in pieces:
+        if data is None:
+            data = await cached_range(file_id, first, last)
+        if data is not None:
+            yield data
+            continue
+        async for chunk in await stream_range(tg_connect, file_id, index, first, last, remote):
+            yield chunk
+
+async def yield_multipart(tg_connect: utils.ByteStreamer, file_id, index: int, multipart: MultipartRanges, layout=None):
+    """Yields a multipart/byteranges body, streaming the ranges one after the other."""
+    for from_bytes, until_bytes in multipart.ranges:
+        yield multipart.part_header(from_bytes, until_bytes)
+        async for chunk in yield_range(tg_connect, file_id, index, from_bytes, until_bytes, layout):
+            yield chunk
+    yield multipart.closing()
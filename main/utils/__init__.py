@@ -1,7 +1,21 @@
 # This file is a part of TG-Direct-Link-Generator
 
-from .keepalive import ping_server
-from .config_parser import TokenParser
-from .time_format import get_readable_time
-from .file_properties import get_hash, get_name
-from .custom_dl import ByteStreamer, offset_fix, chunk_size
\ No newline at end of file
+from importlib import import_module
+
+# imported on first use, so modules like .workers load without the caches and metadata store behind .custom_dl
+_EXPORTS = {
+    "ping_server": ".keepalive",
+    "TokenParser": ".config_parser",
+    "get_readable_time": ".time_format",
+    "get_hash": ".file_properties",
+    "get_name": ".file_properties",
+    "ByteStreamer": ".custom_dl",
+    "offset_fix": ".custom_dl",
+    "chunk_size": ".custom_dl",
+}
+
+
+def __getattr__(name):
+    if name not in _EXPORTS:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    return getattr(import_module(_EXPORTS[name], __name__), name)
@@ -0,0 +1,334 @@
+# This file is a part of TG-Direct-Link-Generator
+
+import os
+import time
+import asyncio
+import logging
+from collections import OrderedDict
+from aiohttp import web
+from main.vars import Var
+from pyrogram.file_id import FileId
+from typing import Callable, Dict, List, Optional, Tuple
+
+# the biggest chunk upload.GetFile returns, every cached chunk is aligned to it
+CACHE_CHUNK_SIZE = 1024 * 1024
+
+
+def chunk_key(file_id: FileId) -> str:
+    """
+    Returns the cache key of a media file. It only depends on the media itself,
+    so every client that fetches the file shares the same cached chunks.
+    """
+    if file_id.thumbnail_size:
+        return f"{file_id.media_id}_{file_id.thumbnail_size}"
+    return str(file_id.media_id)
+
+
+class _DiskEntry:
+    __slots__ = ("size", "hits", "last_used", "pins")
+
+    def __init__(self, size: int, hits: int = 1, last_used: float = 0.0):
+        self.size = size
+        self.hits = hits
+        self.last_used = last_used or time.time()
+        self.pins = 0
+
+
+class DiskChunkCache:
+    def __init__(self, path: str, max_bytes: int, admit_after: int):
+        """A disk cache of fixed-size chunks of telegram files.
+        attributes:
+            path: the directory the chunks are stored in, one sub directory per media.
+            max_bytes: the byte budget of the cache, 0 disables it.
+            admit_after: how many times a chunk has to be requested before it's written to disk.
+            hits, misses: how many chunk lookups were answered from disk or not.
+
+        functions:
+            read: returns the cached bytes of a chunk request, if the chunk is on disk.
+            store: writes a chunk fetched from telegram to disk once it's popular enough.
+            lookup: returns the files holding a byte range, if the whole range is on disk.
+            release: lets the chunks of a range returned by lookup be evicted again.
+
+        Chunks are evicted by popularity (hits, then last use) when the budget is exceeded.
+        """
+        self.path = path
+        self.max_bytes = max_bytes
+        self.admit_after = max(1, admit_after)
+        self.used_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.entries: Dict[Tuple[str, int], _DiskEntry] = {}
+        self.requests: Dict[Tuple[str, int], int] = {}
+        self.writing = set()
+        if self.enabled:
+            self.load()
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_bytes > 0
+
+    def chunk_path(self, key: str, index: int) -> str:
+        return os.path.join(self.path, key, str(index))
+
+    def load(self) -> None:
+        """
+        Indexes the chunks left on disk by a previous run.
+        """
+        os.makedirs(self.path, exist_ok=True)
+        for key in os.listdir(self.path):
+            directory = os.path.join(self.path, key)
+            if not os.path.isdir(directory):
+                continue
+            for name in os.listdir(directory):
+                chunk_file = os.path.join(directory, name)
+                if not os.path.isfile(chunk_file):
+                    continue
+                if not name.isdigit():
+                    os.remove(chunk_file)
+                    continue
+                stat = os.stat(chunk_file)
+                self.entries[(key, int(name))] = _DiskEntry(stat.st_size, last_used=stat.st_mtime)
+                self.used_bytes += stat.st_size
+        logging.info(f"Loaded {len(self.entries)} cached chunks ({self.used_bytes} bytes) from {self.path}")
+        self.evict()
+
+    def record_request(self, chunk: Tuple[str, int]) -> int:
+        """
+        Counts a request for a chunk that isn't on disk and returns its popularity.
+        The counters are halved when there are too many of them, so old popularity fades away.
+        """
+        hits = self.requests.get(chunk, 0) + 1
+        self.requests[chunk] = hits
+        if len(self.requests) > 65536:
+            self.requests = {k: v // 2 for k, v in self.requests.items() if v > 1}
+        return hits
+
+    async def read(self, key: str, offset: int, limit: int) -> Optional[bytes]:
+        if not self.enabled:
+            return None
+        index, inner = divmod(offset, CACHE_CHUNK_SIZE)
+        entry = self.entries.get((key, index))
+        # a chunk shorter than CACHE_CHUNK_SIZE is the tail of the file
+        if entry is None or (entry.size < inner + limit and entry.size == CACHE_CHUNK_SIZE):
+            self.record_request((key, index))
+            self.misses += 1
+            return None
+        self.hits += 1
+        entry.hits += 1
+        entry.last_used = time.time()
+        entry.pins += 1
+        try:
+            return await asyncio.get_running_loop().run_in_executor(
+                None, self._read_file, self.chunk_path(key, index), inner, limit
+            )
+        except OSError:
+            logging.warning(f"Failed reading cached chunk {index} of {key}", exc_info=True)
+            self._forget((key, index))
+            return None
+        finally:
+            entry.pins -= 1
+
+    @staticmethod
+    def _read_file(path: str, offset: int, limit: int) -> bytes:
+        with open(path, "rb") as f:
+            f.seek(offset)
+            return f.read(limit)
+
+    def store(self, key: str, offset: int, limit: int, data: bytes) -> None:
+        """
+        Writes a whole chunk to disk in the background, if it has been requested often enough.
+        """
+        if not self.enabled or limit != CACHE_CHUNK_SIZE or offset % CACHE_CHUNK_SIZE or not data:
+            return
+        chunk = (key, offset // CACHE_CHUNK_SIZE)
+        if chunk in self.entries or chunk in self.writing:
+            return
+        if self.requests.get(chunk, 0) < self.admit_after:
+            return
+        self.writing.add(chunk)
+        future = asyncio.get_running_loop().run_in_executor(
+            None, self._write_file, self.chunk_path(*chunk), data
+        )
+        future.add_done_callback(lambda f: self._stored(chunk, len(data), f))
+
+    @staticmethod
+    def _write_file(path: str, data: bytes) -> None:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path + ".tmp", "wb") as f:
+            f.write(data)
+        os.replace(path + ".tmp", path)
+
+    def _stored(self, chunk: Tuple[str, int], size: int, future: asyncio.Future) -> None:
+        self.writing.discard(chunk)
+        if future.exception():
+            logging.warning(f"Failed caching chunk {chunk[1]} of {chunk[0]}: {future.exception()!r}")
+            return
+        self.entries[chunk] = _DiskEntry(size, hits=self.requests.pop(chunk, 1))
+        self.used_bytes += size
+        self.evict()
+
+    def lookup(self, key: str, from_bytes: int, until_bytes: int, file_size: int) -> Optional[List[Tuple[str, int, int]]]:
+        """
+        Returns (path, offset, count) pieces covering the byte range, or None if any chunk is missing.
+        The chunks are pinned until `release` is called with the same range.
+        """
+        if not self.enabled:
+            return None
+        first, last = from_bytes // CACHE_CHUNK_SIZE, until_bytes // CACHE_CHUNK_SIZE
+        chunks = [(key, index) for index in range(first, last + 1)]
+        for chunk in chunks:
+            entry = self.entries.get(chunk)
+            if entry is None or entry.size != min(CACHE_CHUNK_SIZE, file_size - chunk[1] * CACHE_CHUNK_SIZE):
+                return None
+        pieces = []
+        now = time.time()
+        self.hits += len(chunks)
+        for _, index in chunks:
+            entry = self.entries[(key, index)]
+            entry.hits += 1
+            entry.last_used = now
+            entry.pins += 1
+            start = max(from_bytes, index * CACHE_CHUNK_SIZE)
+            end = min(until_bytes + 1, index * CACHE_CHUNK_SIZE + entry.size)
+            pieces.append((self.chunk_path(key, index), start - index * CACHE_CHUNK_SIZE, end - start))
+        return pieces
+
+    def release(self, key: str, from_bytes: int, until_bytes: int) -> None:
+        for index in range(from_bytes // CACHE_CHUNK_SIZE, until_bytes // CACHE_CHUNK_SIZE + 1):
+            entry = self.entries.get((key, index))
+            if entry is not None:
+                entry.pins -= 1
+
+    def evict(self) -> None:
+        """
+        Removes the least popular chunks until the cache is back under 90% of its budget.
+        """
+        if self.used_bytes <= self.max_bytes:
+            return
+        target = self.max_bytes * 0.9
+        victims = sorted(
+            (chunk for chunk, entry in self.entries.items() if not entry.pins),
+            key=lambda chunk: (self.entries[chunk].hits, self.entries[chunk].last_used),
+        )
+        for chunk in victims:
+            if self.used_bytes <= target:
+                break
+            self._forget(chunk)
+        # let the popularity of the survivors fade, so new hot chunks can replace them
+        for entry in self.entries.values():
+            entry.hits = max(1, entry.hits // 2)
+
+    def _forget(self, chunk: Tuple[str, int]) -> None:
+        entry = self.entries.pop(chunk, None)
+        if entry is None:
+            return
+        self.used_bytes -= entry.size
+        try:
+            os.remove(self.chunk_path(*chunk))
+        except OSError:
+            pass
+
+
+class MemoryChunkCache:
+    def __init__(self, max_bytes: int):
+        """A process wide LRU cache of recently served chunks, shared by every ByteStreamer.
+        attributes:
+            max_bytes: the byte budget of the cache, 0 disables it.
+            hits, misses: how many lookups were answered from the cache or not.
+
+        functions:
+            get: returns the cached bytes of a chunk request.
+            put: caches the bytes of a chunk request.
+
+        When the cache is full a new chunk only replaces the least recently used one
+        if it has been requested at least as often (TinyLFU admission), so a single
+        long download can't flush the chunks every viewer keeps seeking to.
+        """
+        self.max_bytes = max_bytes
+        self.used_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.chunks: "OrderedDict[Tuple[str, int, int], bytes]" = OrderedDict()
+        self.frequency: Dict[Tuple[str, int, int], int] = {}
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_bytes > 0
+
+    def get(self, key: str, offset: int, limit: int) -> Optional[bytes]:
+        if not self.enabled:
+            return None
+        chunk = (key, offset, limit)
+        self._count(chunk)
+        data = self.chunks.get(chunk)
+        if data is None and limit < CACHE_CHUNK_SIZE:
+            # smaller requests can be answered from the aligned 1 MiB chunk around them
+            inner = offset % CACHE_CHUNK_SIZE
+            outer = self.chunks.get((key, offset - inner, CACHE_CHUNK_SIZE))
+            if outer is not None:
+                chunk = (key, offset - inner, CACHE_CHUNK_SIZE)
+                data = outer[inner:inner + limit]
+        if data is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.chunks.move_to_end(chunk)
+        return data
+
+    def put(self, key: str, offset: int, limit: int, data: bytes) -> None:
+        if not self.enabled or not data or len(data) > self.max_bytes:
+            return
+        chunk = (key, offset, limit)
+        if chunk in self.chunks:
+            self.chunks.move_to_end(chunk)
+            return
+        while self.used_bytes + len(data) > self.max_bytes:
+            victim = next(iter(self.chunks))
+            if self.frequency.get(victim, 0) > self.frequency.get(chunk, 0):
+                return
+            self.used_bytes -= len(self.chunks.pop(victim))
+        self.chunks[chunk] = data
+        self.used_bytes += len(data)
+
+    def _count(self, chunk: Tuple[str, int, int]) -> None:
+        self.frequency[chunk] = self.frequency.get(chunk, 0) + 1
+        if len(self.frequency) > 65536:
+            self.frequency = {k: v // 2 for k, v in self.frequency.items() if v > 1}
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "chunks": len(self.chunks),
+            "bytes": self.used_bytes,
+        }
+
+
+class ChunkFileResponse(web.StreamResponse):
+    def __init__(self, pieces: List[Tuple[str, int, int]], release: Callable, **kwargs):
+        """
+        Serves a byte range that is fully on disk from the cached chunk files,
+        using sendfile so the bytes never pass through python.
+        """
+        super().__init__(**kwargs)
+        self.pieces = pieces
+        self.release = release
+
+    async def prepare(self, request: web.BaseRequest):
+        if self.prepared:
+            return await super().prepare(request)
+        try:
+            writer = await super().prepare(request)
+            if request.method != "HEAD":
+                loop = asyncio.get_running_loop()
+                for path, offset, count in self.pieces:
+                    with open(path, "rb") as f:
+                        await loop.sendfile(request.transport, f, offset, count)
+            await self.write_eof()
+            return writer
+        finally:
+            self.release()
+
+
+memory_cache = MemoryChunkCache(Var.MEMORY_CACHE_SIZE * 1024 * 1024)
+disk_cache = DiskChunkCache(Var.DISK_CACHE_DIR, Var.DISK_CACHE_SIZE * 1024 * 1024, Var.DISK_CACHE_ADMIT)
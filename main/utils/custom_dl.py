@@ -1,19 +1,31 @@
 # This file is a part of TG-Direct-Link-Generator
 
 import math
+import time
 import asyncio
 import logging
+from collections import deque
 from main import Var
-from typing import Dict, Union
-from main.bot import work_loads
+from typing import Deque, List, Optional, Tuple, Union
+from main.bot import multi_clients, work_loads
 from pyrogram import Client, utils, raw
 from .file_properties import get_file_ids
-from pyrogram.session import Session, Auth
-from pyrogram.errors import AuthBytesInvalid
+from .metadata import file_metadata
+from .scheduler import scheduler
+from .metrics import bytes_served, getfile_errors, getfile_seconds, stream_first_byte_seconds, streams_aborted
+from .single_flight import SingleFlight
+from .chunk_cache import CACHE_CHUNK_SIZE, chunk_key, disk_cache, memory_cache
+from .media_sessions import MediaSessionPool, get_media_session_pool
+from pyrogram.errors import (
+    FileReferenceExpired, FloodWait, InternalServerError, RPCError, ServiceUnavailable
+)
 from main.server.exceptions import FIleNotFound
 from pyrogram.file_id import FileId, FileType, ThumbnailSource
 
 
+chunk_fetches = SingleFlight()
+
+
 async def chunk_size(length):
     return 2 ** max(min(math.ceil(math.log2(length / 1024)), 10), 2) * 1024
 
@@ -28,32 +40,33 @@ class ByteStreamer:
         """A custom class that holds the cache of a specific client and class functions.
         attributes:
             client: the client that the cache is for.
-            cached_file_ids: a dict of cached file IDs.
-            cached_file_properties: a dict of cached file properties.
         
         functions:
             generate_file_properties: returns the properties for a media of a specific message contained in Tuple.
-            generate_media_session: returns the media session for the DC that contains the media file.
+            refresh_file_properties: generates the properties of a media again, e.g. after its file reference expired.
+            generate_media_session: returns the media session pool for the DC that contains the media file.
             yield_file: yield a file from telegram servers for streaming.
+            get_chunk: returns a single chunk of the file, from the chunk caches or telegram servers.
+            read_bytes: returns any byte range of the file, e.g. to read its headers.
+            get_thumbnail: returns the thumbnail picked for the file when its properties were generated.
+            fetch_chunk: requests a single chunk of the file through a media session pool.
             
         This is a modified version of the <https://github.com/eyaadh/megadlbot_oss/blob/master/mega/telegram/utils/custom_download.py>
         Thanks to Eyaadh <https://github.com/eyaadh>
         """
-        self.clean_timer = 30 * 60
         self.client: Client = client
-        self.cached_file_ids: Dict[int, FileId] = {}
-        asyncio.create_task(self.clean_cache())
 
     async def get_file_properties(self, message_id: int) -> FileId:
         """
         Returns the properties of a media of a specific message in a FIleId class.
-        if the properties are cached, then it'll return the cached results.
+        if the properties are in the shared metadata cache, then it'll return the cached results.
         or it'll generate the properties from the Message ID and cache them.
         """
-        if message_id not in self.cached_file_ids:
-            await self.generate_file_properties(message_id)
+        file_id = file_metadata.get(message_id)
+        if file_id is None:
+            file_id = await self.generate_file_properties(message_id)
             logging.debug(f"Cached file properties for message with ID {message_id}")
-        return self.cached_file_ids[message_id]
+        return file_id
     
     async def generate_file_properties(self, message_id: int) -> FileId:
         """
@@ -65,65 +78,22 @@ class ByteStreamer:
         if not file_id:
             logging.debug(f"Message with ID {message_id} not found")
             raise FIleNotFound
-        self.cached_file_ids[message_id] = file_id
-        logging.debug(f"Cached media message with ID {message_id}")
-        return self.cached_file_ids[message_id]
+        return file_id
 
-    async def generate_media_session(self, client: Client, file_id: FileId) -> Session:
+    async def refresh_file_properties(self, file_id: FileId) -> FileId:
         """
-        Generates the media session for the DC that contains the media file.
-        This is required for getting the bytes from Telegram servers.
+        Fetches the properties of a media file again, e.g. after its file reference expired.
         """
+        logging.debug(f"Refreshing file properties for message with ID {file_id.message_id}")
+        file_metadata.delete(file_id.message_id)
+        return await self.generate_file_properties(file_id.message_id)
 
-        media_session = client.media_sessions.get(file_id.dc_id, None)
-
-        if media_session is None:
-            if file_id.dc_id != await client.storage.dc_id():
-                media_session = Session(
-                    client,
-                    file_id.dc_id,
-                    await Auth(
-                        client, file_id.dc_id, await client.storage.test_mode()
-                    ).create(),
-                    await client.storage.test_mode(),
-                    is_media=True,
-                )
-                await media_session.start()
-
-                for _ in range(6):
-                    exported_auth = await client.send(
-                        raw.functions.auth.ExportAuthorization(dc_id=file_id.dc_id)
-                    )
-
-                    try:
-                        await media_session.send(
-                            raw.functions.auth.ImportAuthorization(
-                                id=exported_auth.id, bytes=exported_auth.bytes
-                            )
-                        )
-                        break
-                    except AuthBytesInvalid:
-                        logging.debug(
-                            f"Invalid authorization bytes for DC {file_id.dc_id}"
-                        )
-                        continue
-                else:
-                    await media_session.stop()
-                    raise AuthBytesInvalid
-            else:
-                media_session = Session(
-                    client,
-                    file_id.dc_id,
-                    await client.storage.auth_key(),
-                    await client.storage.test_mode(),
-                    is_media=True,
-                )
-                await media_session.start()
-            logging.debug(f"Created media session for DC {file_id.dc_id}")
-            client.media_sessions[file_id.dc_id] = media_session
-        else:
-            logging.debug(f"Using cached media session for DC {file_id.dc_id}")
-        return media_session
+    async def generate_media_session(self, client: Client, file_id: FileId) -> MediaSessionPool:
+        """
+        Returns the pool of media sessions for the DC that contains the media file.
+        This is required for getting the bytes from Telegram servers.
+        """
+        return await get_media_session_pool(client, file_id.dc_id)
 
 
     @staticmethod
@@ -180,60 +150,242 @@ class ByteStreamer:
         last_part_cut: int,
         part_count: int,
         chunk_size: int,
+        stripes: Optional[List[Tuple[int, "ByteStreamer"]]] = None,
     ) -> Union[str, None]:
         """
         Custom generator that yields the bytes of the media file.
+        If stripes are given, the parts are spread round-robin across this client
+        and the striped clients, each using its own media session.
+        A client that gets a FloodWait is taken out of rotation and its share of the
+        stream moves to another client, continuing at the same part.
         Modded from <https://github.com/eyaadh/megadlbot_oss/blob/master/mega/telegram/utils/custom_download.py#L20>
         Thanks to Eyaadh <https://github.com/eyaadh>
         """
-        client = self.client
-        work_loads[index] += 1
+        streamers = [(index, self)] + list(stripes or [])
+        # the client index behind every media session, kept in sync for work_loads
+        slots = [i for i, _ in streamers]
+        for i in slots:
+            work_loads[i] += 1
         logging.debug(f"Starting to yielding file with client {index}.")
-        media_session = await self.generate_media_session(client, file_id)
+        stream_started = time.monotonic()
 
         current_part = 1
-
-        location = await self.get_location(file_id)
+        next_part = 1
+        pending: Deque[asyncio.Future] = deque()
 
         try:
-            r = await media_session.send(
-                raw.functions.upload.GetFile(
-                    location=location, offset=offset, limit=chunk_size
-                ),
+            sessions = await asyncio.gather(
+                *[s.generate_media_session(s.client, file_id) for _, s in streamers],
+                return_exceptions=True,
             )
-            if isinstance(r, raw.types.upload.File):
-                while current_part <= part_count:
-                    chunk = r.bytes
-                    if not chunk:
-                        break
-                    offset += chunk_size
-                    if part_count == 1:
-                        yield chunk[first_part_cut:last_part_cut]
-                        break
-                    if current_part == 1:
-                        yield chunk[first_part_cut:]
-                    if 1 < current_part <= part_count:
-                        yield chunk
-
-                    r = await media_session.send(
-                        raw.functions.upload.GetFile(
-                            location=location, offset=offset, limit=chunk_size
-                        ),
-                    )
+            if isinstance(sessions[0], BaseException):
+                raise sessions[0]
+            media_sessions = [sessions[0]]
+            for (i, streamer), session in list(zip(streamers, sessions))[1:]:
+                if isinstance(session, BaseException):
+                    logging.warning(f"Dropping client {i} from stripe: {session!r}")
+                    work_loads[i] -= 1
+                    slots.remove(i)
+                else:
+                    media_sessions.append(session)
+            if len(media_sessions) > 1:
+                logging.debug(f"Striping file across clients {slots}.")
+
+            window = max(1, Var.PREFETCH_WINDOW) * len(media_sessions)
+            location = await self.get_location(file_id)
+            refresh_lock = asyncio.Lock()
+            failover_lock = asyncio.Lock()
+
+            async def failover(slot: int, flooded: MediaSessionPool, seconds: int) -> None:
+                # moves a flooded slot to the best client that isn't flood waited
+                scheduler.trip(flooded.client, seconds)
+                async with failover_lock:
+                    if media_sessions[slot] is not flooded:
+                        return
+                    new_index = scheduler.pick(file_id.dc_id, exclude=slots)
+                    client = multi_clients[new_index]
+                    wait = scheduler.blocked_for(client)
+                    if wait > Var.FLOOD_WAIT_THRESHOLD:
+                        raise FloodWait(value=math.ceil(wait))
+                    if wait:
+                        logging.warning(f"Every client is flood waited, pausing the stream for {wait:.0f}s")
+                        await asyncio.sleep(wait)
+                    pool = await get_media_session_pool(client, file_id.dc_id)
+                    logging.info(f"Moving stream from client {slots[slot]} to client {new_index} after a FloodWait")
+                    work_loads[slots[slot]] -= 1
+                    work_loads[new_index] += 1
+                    slots[slot] = new_index
+                    media_sessions[slot] = pool
+
+            async def fetch_part(part: int) -> Optional[bytes]:
+                # retries the part with backoff, so a failing chunk doesn't cut the response short
+                nonlocal file_id, location
+                part_offset = offset + (part - 1) * chunk_size
+                slot = (part - 1) % len(media_sessions)
+                for attempt in range(Var.CHUNK_RETRIES + 1):
+                    used_file_id = file_id
+                    media_session = media_sessions[slot]
+                    try:
+                        return await self.get_chunk(media_session, file_id, location, part_offset, chunk_size)
+                    except FileReferenceExpired:
+                        if attempt == Var.CHUNK_RETRIES:
+                            raise
+                        async with refresh_lock:
+                            if file_id is used_file_id:
+                                file_id = await self.refresh_file_properties(file_id)
+                                location = await self.get_location(file_id)
+                    except FloodWait as e:
+                        if attempt == Var.CHUNK_RETRIES:
+                            raise
+                        await failover(slot, media_session, e.value)
+                    except (TimeoutError, asyncio.TimeoutError, OSError, InternalServerError, ServiceUnavailable) as e:
+                        if attempt == Var.CHUNK_RETRIES:
+                            raise
+                        delay = min(0.5 * 2 ** attempt, 8)
+                        logging.debug(f"Retrying part {part} at offset {part_offset} in {delay}s: {e!r}")
+                        await asyncio.sleep(delay)
+
+            def fill_window():
+                # keep at most `window` GetFile requests in flight, issued in part order
+                nonlocal next_part
+                while next_part <= part_count and len(pending) < window:
+                    pending.append(asyncio.ensure_future(fetch_part(next_part)))
+                    next_part += 1
 
-                    current_part += 1
-        except (TimeoutError, AttributeError):
-            pass
+            fill_window()
+            while pending:
+                chunk = await pending.popleft()
+                fill_window()
+                if not chunk:
+                    break
+                if part_count == 1:
+                    piece = chunk[first_part_cut:last_part_cut]
+                elif current_part == 1:
+                    piece = chunk[first_part_cut:]
+                elif current_part == part_count:
+                    piece = chunk[:last_part_cut]
+                else:
+                    piece = chunk
+                if current_part == 1:
+                    stream_first_byte_seconds.observe(time.monotonic() - stream_started)
+                bytes_served.inc(slots[(current_part - 1) % len(slots)], amount=len(piece))
+                yield piece
+                current_part += 1
+        except (TimeoutError, asyncio.TimeoutError, AttributeError, OSError, RPCError) as e:
+            streams_aborted.inc(index)
+            logging.error(f"Giving up streaming with client {index} after {current_part - 1} parts: {e!r}")
         finally:
-            logging.debug("Finished yielding file with {current_part} parts.")
-            work_loads[index] -= 1
+            for task in pending:
+                task.cancel()
+            # the cancelled requests settle their accounting before the client's load is released
+            await asyncio.gather(*pending, return_exceptions=True)
+            logging.debug(f"Finished yielding file with {current_part - 1} parts.")
+            for i in slots:
+                work_loads[i] -= 1
 
-    
-    async def clean_cache(self) -> None:
+    async def get_chunk(
+        self,
+        media_session: MediaSessionPool,
+        file_id: FileId,
+        location: Union[raw.types.InputPhotoFileLocation,
+                        raw.types.InputDocumentFileLocation,
+                        raw.types.InputPeerPhotoFileLocation,],
+        offset: int,
+        limit: int,
+    ) -> Optional[bytes]:
+        """
+        Returns the bytes of a chunk of the media file, from the memory or disk cache
+        if it's there or from telegram servers otherwise.
+        """
+        key = chunk_key(file_id)
+        chunk = memory_cache.get(key, offset, limit)
+        if chunk is not None:
+            return chunk
+
+        async def load_chunk() -> Optional[bytes]:
+            chunk = await disk_cache.read(key, offset, limit)
+            if chunk is None:
+                r = await self.fetch_chunk(media_session, location, offset, limit)
+                if not isinstance(r, raw.types.upload.File):
+                    return None
+                chunk = r.bytes
+                disk_cache.store(key, offset, limit, chunk)
+            memory_cache.put(key, offset, limit, chunk)
+            return chunk
+
+        # concurrent requests for the same chunk, from any client, share one fetch
+        return await chunk_fetches.do((key, offset, limit), load_chunk)
+
+    async def read_bytes(self, file_id: FileId, offset: int, length: int) -> bytes:
+        """
+        Returns `length` bytes of the media file from `offset` (less at the end of the file).
+        The range is split in GetFile requests telegram accepts: 4 KiB aligned
+        and never crossing a 1 MiB boundary.
         """
-        function to clean the cache to reduce memory usage
+        media_session = await self.generate_media_session(self.client, file_id)
+        location = await self.get_location(file_id)
+        end = min(offset + length, file_id.file_size or offset + length)
+        parts = []
+        position = offset
+        while position < end:
+            start = position - position % 4096
+            stop = min((start // CACHE_CHUNK_SIZE + 1) * CACHE_CHUNK_SIZE, -(-end // 4096) * 4096)
+            chunk = await self.get_chunk(media_session, file_id, location, start, stop - start)
+            if not chunk:
+                break
+            parts.append(chunk[position - start:end - start])
+            if len(chunk) < stop - start:
+                break
+            position = stop
+        return b"".join(parts)
+
+    async def get_thumbnail(self, file_id: FileId) -> Optional[bytes]:
+        """
+        Returns the bytes of the file's thumbnail, None if it has none.
+        A thumbnail fits in one aligned 1 MiB chunk, so it's requested (and cached) as one.
+        """
+        thumb_size = getattr(file_id, "thumb_size", "")
+        if not thumb_size:
+            return None
+        thumb_id = FileId(
+            file_type=file_id.file_type,
+            dc_id=file_id.dc_id,
+            file_reference=file_id.file_reference,
+            media_id=file_id.media_id,
+            access_hash=file_id.access_hash,
+            thumbnail_size=thumb_size,
+        )
+        setattr(thumb_id, "file_size", 0)
+        return await self.read_bytes(thumb_id, 0, CACHE_CHUNK_SIZE) or None
+
+    @staticmethod
+    async def fetch_chunk(
+        media_session: MediaSessionPool,
+        location: Union[raw.types.InputPhotoFileLocation,
+                        raw.types.InputDocumentFileLocation,
+                        raw.types.InputPeerPhotoFileLocation,],
+        offset: int,
+        limit: int,
+    ) -> raw.types.upload.File:
         """
-        while True:
-            await asyncio.sleep(self.clean_timer)
-            self.cached_file_ids.clear()
-            logging.debug("Cleaned the cache")
+        Requests a single chunk of the media file through the media session pool.
+        The request is recorded in the scheduler's stats of the pool's client.
+        """
+        client = media_session.client
+        started = scheduler.request_started(client)
+        try:
+            r = await media_session.send(
+                raw.functions.upload.GetFile(
+                    location=location, offset=offset, limit=limit
+                ),
+            )
+        except asyncio.CancelledError:
+            scheduler.request_failed(client, weight=0)
+            raise
+        except Exception:
+            scheduler.request_failed(client)
+            getfile_errors.inc(media_session.dc_id)
+            raise
+        scheduler.request_finished(client, started, len(getattr(r, "bytes", b"")))
+        getfile_seconds.observe(time.monotonic() - started, media_session.dc_id)
+        return r
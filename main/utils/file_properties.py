@@ -1,17 +1,23 @@
 # This file is a part of TG-Direct-Link-Generator
 
+import asyncio
+import logging
 from urllib.parse import quote_plus
 from pyrogram import Client
-from typing import Any, Optional
-from pyrogram.types import Message
+from typing import Any, Dict, List, Optional, Tuple
+from pyrogram.types import Message, Thumbnail
 from pyrogram.file_id import FileId
 from pyrogram.raw.types.messages import Messages
 from main.server.exceptions import FIleNotFound
 from main.utils.Translation import Language
 from main.utils.human_readable import humanbytes
 from main.vars import Var
+from main.utils.metadata import file_metadata
 from pyrogram.types import InlineKeyboardButton, InlineKeyboardMarkup
 
+# the thumbnail served for a file is the smallest one at least this big, in pixels
+THUMBNAIL_MIN_SIZE = 320
+
 async def parse_file_id(message: "Message") -> Optional[FileId]:
     media = get_media_from_message(message)
     if media:
@@ -23,18 +29,102 @@ async def parse_file_unique_id(message: "Messages") -> Optional[str]:
         return media.file_unique_id
 
 async def get_file_ids(client: Client, chat_id: int, message_id: int) -> Optional[FileId]:
-    message = await client.get_messages(chat_id, message_id)
+    return await message_batcher.get_file_ids(client, chat_id, message_id)
+
+async def file_ids_from_message(message: "Message") -> Optional[FileId]:
     if message.empty:
         raise FIleNotFound
     media = get_media_from_message(message)
     file_unique_id = await parse_file_unique_id(message)
     file_id = await parse_file_id(message)
+    if not file_id:
+        return None
     setattr(file_id, "file_size", getattr(media, "file_size", 0))
     setattr(file_id, "mime_type", getattr(media, "mime_type", ""))
     setattr(file_id, "file_name", getattr(media, "file_name", ""))
     setattr(file_id, "unique_id", file_unique_id)
+    setattr(file_id, "message_id", message.id)
+    setattr(file_id, "date", int(message.date.timestamp()) if message.date else 0)
+    thumbnail = pick_thumbnail(getattr(media, "thumbs", None) or [])
+    setattr(file_id, "thumb_size", FileId.decode(thumbnail.file_id).thumbnail_size if thumbnail else "")
     return file_id
 
+
+def pick_thumbnail(thumbs: List[Thumbnail]) -> Optional[Thumbnail]:
+    """
+    Returns the smallest thumbnail that is at least THUMBNAIL_MIN_SIZE pixels on its long side,
+    or the biggest one if they're all smaller.
+    """
+    if not thumbs:
+        return None
+    by_size = sorted(thumbs, key=lambda t: max(t.width, t.height))
+    return next((t for t in by_size if max(t.width, t.height) >= THUMBNAIL_MIN_SIZE), by_size[-1])
+
+
+class MessageBatcher:
+    def __init__(self, delay: float, max_batch: int = 100):
+        """Collects the message lookups made within `delay` seconds and resolves them
+        with one get_messages call per client and chat (up to `max_batch` IDs per call).
+        The properties of every media in BIN_CHANNEL it resolves are put in the metadata cache.
+        """
+        self.delay = delay
+        self.max_batch = max_batch
+        self.batches: Dict[Tuple[Client, int], Dict[int, asyncio.Future]] = {}
+
+    async def get_file_ids(self, client: Client, chat_id: int, message_id: int) -> Optional[FileId]:
+        key = (client, chat_id)
+        batch = self.batches.get(key)
+        if batch is None:
+            batch = self.batches[key] = {}
+            asyncio.get_running_loop().call_later(self.delay, self.flush_due, key, batch)
+        future = batch.get(message_id)
+        if future is None:
+            future = batch[message_id] = asyncio.get_running_loop().create_future()
+            if len(batch) >= self.max_batch:
+                # taken out right away, so lookups made before the flush runs start a new batch
+                del self.batches[key]
+                asyncio.ensure_future(self.flush(key, batch))
+        return await asyncio.shield(future)
+
+    def flush_due(self, key: Tuple[Client, int], batch: Dict[int, asyncio.Future]) -> None:
+        # a batch that filled up was flushed already
+        if self.batches.get(key) is batch:
+            del self.batches[key]
+            asyncio.ensure_future(self.flush(key, batch))
+
+    async def flush(self, key: Tuple[Client, int], batch: Dict[int, asyncio.Future]) -> None:
+        client, chat_id = key
+        try:
+            messages = await client.get_messages(chat_id, list(batch))
+            for message in messages:
+                future = batch.get(message.id)
+                if future is None or future.done():
+                    continue
+                try:
+                    file_id = await file_ids_from_message(message)
+                    if file_id and chat_id == Var.BIN_CHANNEL:
+                        file_metadata.put(file_id)
+                except Exception as e:
+                    future.set_exception(e)
+                    continue
+                future.set_result(file_id)
+        except Exception as e:
+            logging.warning(f"Failed resolving messages {list(batch)} of {chat_id}: {e!r}")
+            for future in batch.values():
+                if not future.done():
+                    future.set_exception(e)
+        finally:
+            for future in batch.values():
+                if not future.done():
+                    future.set_exception(FIleNotFound())
+            for future in batch.values():
+                if not future.cancelled():
+                    # mark the exception as retrieved, in case every waiter went away
+                    future.exception()
+
+
+message_batcher = MessageBatcher(Var.METADATA_BATCH_DELAY / 1000)
+
 def get_media_from_message(message: "Message") -> Any:
     media_types = (
         "audio",
@@ -0,0 +1,255 @@
+# This file is a part of TG-Direct-Link-Generator
+
+import math
+import struct
+import asyncio
+import logging
+from collections import OrderedDict
+from pyrogram.file_id import FileId
+from typing import Dict, List, Optional, Tuple
+from .mp4 import MAX_MOOV_SIZE, is_mp4, iter_boxes, read_top_level_boxes
+from .single_flight import SingleFlight
+
+# fragments are joined into segments of at least this many seconds
+MIN_SEGMENT_DURATION = 4.0
+# the most top level boxes, and seconds, spent walking the fragments of a file that has no sidx box;
+# a file that takes more isn't served as HLS rather than with a cut off playlist
+MAX_FRAGMENT_BOXES = 40000
+MAX_FRAGMENT_SCAN_SECONDS = 30
+MAX_CACHED_INDEXES = 1024
+
+
+class HlsIndex:
+    def __init__(self, init_size: int, segments: List[Tuple[int, int, float]]):
+        """The byte ranges of a fragmented MP4 file that make up its HLS media playlist.
+        Only fragmented files are indexed, a progressive MP4 or any other container is played from its link.
+        attributes:
+            init_size: the length of the initialization section (ftyp and moov) at the start of the file.
+            segments: (offset, length, seconds) of every media segment, each starting with a keyframe fragment.
+
+        functions:
+            playlist: returns the #EXT-X-BYTERANGE playlist of the file.
+        """
+        self.init_size = init_size
+        self.segments = segments
+
+    def playlist(self, uri: str) -> str:
+        target = max(math.ceil(duration) for _, _, duration in self.segments)
+        lines = [
+            "#EXTM3U",
+            "#EXT-X-VERSION:7",
+            f"#EXT-X-TARGETDURATION:{target}",
+            "#EXT-X-MEDIA-SEQUENCE:0",
+            "#EXT-X-PLAYLIST-TYPE:VOD",
+            "#EXT-X-INDEPENDENT-SEGMENTS",
+            f'#EXT-X-MAP:URI="{uri}",BYTERANGE="{self.init_size}@0"',
+        ]
+        for offset, length, duration in self.segments:
+            lines += [f"#EXTINF:{duration:.3f},", f"#EXT-X-BYTERANGE:{length}@{offset}", uri]
+        lines.append("#EXT-X-ENDLIST")
+        return "\n".join(lines) + "\n"
+
+
+def join_fragments(fragments: List[Tuple[int, int, float, bool]]) -> List[Tuple[int, int, float]]:
+    """
+    Joins consecutive (offset, length, seconds, starts with keyframe) fragments into segments
+    of at least MIN_SEGMENT_DURATION, a segment only starts at a keyframe fragment.
+    """
+    segments = []
+    for offset, length, duration, keyframe in fragments:
+        if segments and (not keyframe or segments[-1][2] < MIN_SEGMENT_DURATION):
+            first, joined, seconds = segments[-1]
+            segments[-1] = (first, joined + length, seconds + duration)
+        else:
+            segments.append((offset, length, duration))
+    return segments
+
+
+def parse_sidx(data: bytes, sidx_end: int) -> Optional[List[Tuple[int, int, float, bool]]]:
+    """
+    Returns the fragments a sidx box lists, or None if it points to other sidx boxes.
+    """
+    version = data[8]
+    timescale = struct.unpack_from(">I", data, 16)[0]
+    if version == 0:
+        first_offset = struct.unpack_from(">I", data, 24)[0]
+        position = 28
+    else:
+        first_offset = struct.unpack_from(">Q", data, 28)[0]
+        position = 36
+    count = struct.unpack_from(">H", data, position + 2)[0]
+    position += 4
+    offset = sidx_end + first_offset
+    fragments = []
+    for _ in range(count):
+        size, duration, sap = struct.unpack_from(">III", data, position)
+        position += 12
+        if size >> 31:
+            return None
+        size &= 0x7FFFFFFF
+        fragments.append((offset, size, duration / timescale, bool(sap >> 31)))
+        offset += size
+    return fragments
+
+
+def track_timescales(moov: bytes) -> Tuple[Dict[int, int], Optional[int]]:
+    """
+    Returns the timescale of every track in a moov box and the ID of the first video track.
+    """
+    timescales = {}
+    video_track = None
+    for kind, position, header, size in iter_boxes(moov, 8, len(moov)):
+        if kind != b"trak":
+            continue
+        track_id = timescale = handler = None
+        for inner, p, h, s in iter_boxes(moov, position + header, position + size):
+            if inner == b"tkhd":
+                track_id = struct.unpack_from(">I", moov, p + h + (20 if moov[p + h] == 1 else 12))[0]
+            elif inner == b"mdia":
+                for box, q, hq, sq in iter_boxes(moov, p + h, p + s):
+                    if box == b"mdhd":
+                        timescale = struct.unpack_from(">I", moov, q + hq + (20 if moov[q + hq] == 1 else 12))[0]
+                    elif box == b"hdlr":
+                        handler = moov[q + hq + 8:q + hq + 12]
+        if track_id is None or not timescale:
+            continue
+        timescales[track_id] = timescale
+        if handler == b"vide" and video_track is None:
+            video_track = track_id
+    return timescales, video_track
+
+
+def fragment_start(moof: bytes, track_id: int) -> Optional[int]:
+    """
+    Returns the decode time (tfdt) a movie fragment starts at for a track.
+    """
+    for kind, position, header, size in iter_boxes(moof, 8, len(moof)):
+        if kind != b"traf":
+            continue
+        traf_track = None
+        for inner, p, h, s in iter_boxes(moof, position + header, position + size):
+            if inner == b"tfhd":
+                traf_track = struct.unpack_from(">I", moof, p + h + 4)[0]
+            elif inner == b"tfdt" and traf_track == track_id:
+                return struct.unpack_from(">Q" if moof[p + h] == 1 else ">I", moof, p + h + 4)[0]
+    return None
+
+
+class HlsIndexCache:
+    def __init__(self, max_entries: int):
+        """An LRU cache of the HLS indexes of fragmented MP4 files, by unique ID.
+        Files that can't be served as HLS are cached as None.
+        attributes:
+            max_entries: how many indexes are kept.
+
+        functions:
+            offered: whether a file may have a playlist, i.e. it's an MP4 not already found unservable.
+            get: returns the index of a file, reading it through a ByteStreamer if needed.
+        """
+        self.max_entries = max_entries
+        self.indexes: "OrderedDict[str, Optional[HlsIndex]]" = OrderedDict()
+        self.builds = SingleFlight()
+
+    def offered(self, file_id: FileId) -> bool:
+        if not is_mp4(file_id) or not file_id.file_size:
+            return False
+        key = file_id.unique_id
+        return key not in self.indexes or self.indexes[key] is not None
+
+    async def get(self, streamer, file_id: FileId) -> Optional[HlsIndex]:
+        if not is_mp4(file_id) or not file_id.file_size:
+            return None
+        key = file_id.unique_id
+        if key in self.indexes:
+            self.indexes.move_to_end(key)
+            return self.indexes[key]
+        return await self.builds.do(key, lambda: self.build(streamer, file_id))
+
+    async def build(self, streamer, file_id: FileId) -> Optional[HlsIndex]:
+        try:
+            index = await self.read_index(streamer, file_id)
+        except (ValueError, IndexError, struct.error) as e:
+            logging.info(f"Can't build an HLS index for {file_id.unique_id}: {e!r}")
+            index = None
+        except Exception as e:
+            # not cached, the next request tries again
+            logging.warning(f"Failed reading the HLS index of {file_id.unique_id}: {e!r}")
+            return None
+        self.indexes[file_id.unique_id] = index
+        while len(self.indexes) > self.max_entries:
+            self.indexes.popitem(last=False)
+        if index is not None:
+            logging.debug(f"Built an HLS index of {len(index.segments)} segments for {file_id.unique_id}")
+        return index
+
+    @staticmethod
+    async def read_index(streamer, file_id: FileId) -> Optional[HlsIndex]:
+        boxes = await read_top_level_boxes(streamer, file_id, 64, stop_at=b"moof")
+        if not boxes or boxes[-1][0] != b"moof":
+            # not fragmented: byte ranges of it aren't valid HLS segments
+            return None
+        kinds = [kind for kind, *_ in boxes]
+        if b"moov" not in kinds:
+            return None
+        init_size = max(position + size for kind, position, _, size in boxes if kind == b"moov")
+
+        sidx = next((box for box in boxes if box[0] == b"sidx"), None)
+        if sidx is not None:
+            _, position, _, size = sidx
+            fragments = parse_sidx(await streamer.read_bytes(file_id, position, size), position + size)
+            if fragments:
+                return HlsIndex(init_size, join_fragments(fragments))
+
+        # no usable sidx: walk every fragment and time it by its tfdt
+        _, moov_start, _, moov_size = next(box for box in boxes if box[0] == b"moov")
+        if moov_size > MAX_MOOV_SIZE:
+            return None
+        moov = await streamer.read_bytes(file_id, moov_start, moov_size)
+        if not any(kind == b"mvex" for kind, *_ in iter_boxes(moov, 8, len(moov))):
+            # a moof without mvex in moov isn't a valid fragmented file
+            return None
+        timescales, track_id = track_timescales(moov)
+        if track_id is None:
+            track_id = next(iter(timescales), None)
+        if track_id is None:
+            return None
+        try:
+            fragments = await asyncio.wait_for(
+                HlsIndexCache.read_fragments(streamer, file_id, timescales[track_id], track_id),
+                MAX_FRAGMENT_SCAN_SECONDS,
+            )
+        except asyncio.TimeoutError:
+            raise ValueError(f"reading the fragments took over {MAX_FRAGMENT_SCAN_SECONDS}s")
+        if fragments is None:
+            return None
+        return HlsIndex(init_size, join_fragments(fragments))
+
+    @staticmethod
+    async def read_fragments(
+        streamer, file_id: FileId, timescale: int, track_id: int
+    ) -> Optional[List[Tuple[int, int, float, bool]]]:
+        """
+        Returns every fragment of a file, timed by the tfdt of its moof box.
+        """
+        boxes = await read_top_level_boxes(streamer, file_id, MAX_FRAGMENT_BOXES)
+        if not boxes:
+            return None
+        _, last_position, _, last_size = boxes[-1]
+        if last_position + last_size < file_id.file_size:
+            raise ValueError(f"more than {MAX_FRAGMENT_BOXES} top level boxes")
+        moofs = [(position, size) for kind, position, _, size in boxes if kind == b"moof"]
+        data_end = max(position + size for kind, position, _, size in boxes if kind == b"mdat")
+        starts = []
+        for position, size in moofs:
+            starts.append(fragment_start(await streamer.read_bytes(file_id, position, size), track_id))
+        if None in starts:
+            return None
+        ends = [position for position, _ in moofs[1:]] + [data_end]
+        durations = [(b - a) / timescale for a, b in zip(starts, starts[1:])]
+        durations.append(sum(durations) / len(durations) if durations else MIN_SEGMENT_DURATION)
+        return [
+            (position, end - position, duration, True)
+            for (position, _), end, duration in zip(moofs, ends, durations)
+        ]
+
+hls_indexes = HlsIndexCache(MAX_CACHED_INDEXES)
@@ -0,0 +1,253 @@
+# This file is a part of TG-Direct-Link-Generator
+
+import asyncio
+import logging
+import sqlite3
+from main.vars import Var
+from pyrogram import Client, raw
+from typing import Dict, List, Optional, Set, Tuple
+from pyrogram.session import Session, Auth
+from pyrogram.errors import AuthBytesInvalid, Unauthorized
+
+
+class MediaSessionPool:
+    def __init__(self, client: Client, dc_id: int, size: int):
+        """A pool of media sessions of a client to the DC that holds the files.
+        attributes:
+            client: the client the sessions belong to.
+            dc_id: the DC the sessions are connected to.
+            size: how many sessions the pool grows to when it's busy.
+            auth_key: the authorization key shared by the sessions.
+
+        functions:
+            start: opens the first session, only once even when called concurrently.
+            send: sends a request through the least loaded session, like Session.send.
+            health_check: reconnects the sessions that are down or keep failing.
+            stop: closes every session of the pool.
+        """
+        self.client = client
+        self.dc_id = dc_id
+        self.size = max(1, size)
+        self.auth_key: Optional[bytes] = None
+        self.sessions: List[Session] = []
+        self.in_flight: Dict[Session, int] = {}
+        self.failures: Dict[Session, int] = {}
+        self.restarting: Set[Session] = set()
+        self.lock = asyncio.Lock()
+
+    @property
+    def load(self) -> int:
+        return sum(self.in_flight.values())
+
+    async def start(self) -> None:
+        if self.sessions:
+            return
+        async with self.lock:
+            if not self.sessions:
+                await self.add_session()
+
+    async def add_session(self) -> Session:
+        """
+        Opens one more session. The first session of a DC that isn't the client's home DC
+        creates the auth key and imports the authorization, the others reuse it.
+        """
+        client = self.client
+        test_mode = await client.storage.test_mode()
+        home_dc = self.dc_id == await client.storage.dc_id()
+        session = None
+        if self.auth_key is None and not home_dc:
+            session = await self.resume_session(test_mode)
+
+        if session is None:
+            needs_authorization = self.auth_key is None and not home_dc
+            if self.auth_key is None:
+                if home_dc:
+                    self.auth_key = await client.storage.auth_key()
+                else:
+                    self.auth_key = await Auth(client, self.dc_id, test_mode).create()
+
+            session = Session(client, self.dc_id, self.auth_key, test_mode, is_media=True)
+            await session.start()
+
+            if needs_authorization:
+                for _ in range(6):
+                    exported_auth = await client.invoke(
+                        raw.functions.auth.ExportAuthorization(dc_id=self.dc_id)
+                    )
+
+                    try:
+                        await session.send(
+                            raw.functions.auth.ImportAuthorization(
+                                id=exported_auth.id, bytes=exported_auth.bytes
+                            )
+                        )
+                        break
+                    except AuthBytesInvalid:
+                        logging.debug(f"Invalid authorization bytes for DC {self.dc_id}")
+                        continue
+                else:
+                    await session.stop()
+                    self.auth_key = None
+                    raise AuthBytesInvalid
+                auth_keys.put(await client.storage.user_id(), self.dc_id, self.auth_key)
+
+        self.sessions.append(session)
+        self.in_flight[session] = 0
+        self.failures[session] = 0
+        logging.debug(f"Created media session {len(self.sessions)} for DC {self.dc_id}")
+        return session
+
+    async def resume_session(self, test_mode: bool) -> Optional[Session]:
+        """
+        Opens a session with the auth key stored by a previous run, if it's still authorized.
+        """
+        user_id = await self.client.storage.user_id()
+        auth_key = auth_keys.get(user_id, self.dc_id)
+        if auth_key is None:
+            return None
+        session = Session(self.client, self.dc_id, auth_key, test_mode, is_media=True)
+        try:
+            # Session.start keeps reconnecting when the server doesn't know the key anymore
+            await asyncio.wait_for(session.start(), 15)
+            await session.send(raw.functions.updates.GetState())
+        except (asyncio.TimeoutError, TimeoutError, OSError, Unauthorized) as e:
+            logging.info(f"Stored auth key for DC {self.dc_id} can't be used anymore: {e!r}")
+            auth_keys.delete(user_id, self.dc_id)
+            await session.stop()
+            return None
+        self.auth_key = auth_key
+        logging.debug(f"Resumed media session for DC {self.dc_id} with a stored auth key")
+        return session
+
+    async def send(self, data, *args, **kwargs):
+        await self.start()
+        healthy = [s for s in self.sessions if s not in self.restarting] or self.sessions
+        session = min(healthy, key=self.in_flight.get)
+        if self.in_flight[session] and len(self.sessions) < self.size and not self.lock.locked():
+            asyncio.ensure_future(self.grow())
+        self.in_flight[session] += 1
+        try:
+            result = await session.send(data, *args, **kwargs)
+        except (OSError, TimeoutError):
+            self.failures[session] += 1
+            if self.failures[session] >= 3:
+                asyncio.ensure_future(self.reconnect(session))
+            raise
+        finally:
+            self.in_flight[session] -= 1
+        self.failures[session] = 0
+        return result
+
+    async def grow(self) -> None:
+        async with self.lock:
+            if len(self.sessions) >= self.size:
+                return
+            try:
+                await self.add_session()
+            except Exception as e:
+                logging.warning(f"Failed adding a media session for DC {self.dc_id}: {e!r}")
+
+    async def reconnect(self, session: Session) -> None:
+        if session in self.restarting:
+            return
+        self.restarting.add(session)
+        logging.info(f"Reconnecting a media session for DC {self.dc_id}")
+        try:
+            await session.restart()
+            self.failures[session] = 0
+        except Exception as e:
+            logging.warning(f"Failed reconnecting a media session for DC {self.dc_id}: {e!r}")
+        finally:
+            self.restarting.discard(session)
+
+    async def health_check(self) -> None:
+        for session in list(self.sessions):
+            if not session.is_started.is_set() or self.failures[session]:
+                await self.reconnect(session)
+
+    async def stop(self) -> None:
+        for session in self.sessions:
+            await session.stop()
+        self.sessions.clear()
+
+
+class AuthKeyStore:
+    def __init__(self, db_path: str = ""):
+        """Keeps the auth keys of the media sessions in an SQLite file, so a restart
+        doesn't have to generate and authorize them again. Does nothing without a file."""
+        self.db: Optional[sqlite3.Connection] = None
+        if db_path:
+            self.db = sqlite3.connect(db_path, isolation_level=None, check_same_thread=False)
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS auth_keys ("
+                "user_id INTEGER, dc_id INTEGER, auth_key BLOB, PRIMARY KEY (user_id, dc_id))"
+            )
+
+    def get(self, user_id: int, dc_id: int) -> Optional[bytes]:
+        if self.db is None:
+            return None
+        row = self.db.execute(
+            "SELECT auth_key FROM auth_keys WHERE user_id = ? AND dc_id = ?", (user_id, dc_id)
+        ).fetchone()
+        return row[0] if row else None
+
+    def put(self, user_id: int, dc_id: int, auth_key: bytes) -> None:
+        if self.db is not None:
+            self.db.execute("INSERT OR REPLACE INTO auth_keys VALUES (?, ?, ?)", (user_id, dc_id, auth_key))
+
+    def delete(self, user_id: int, dc_id: int) -> None:
+        if self.db is not None:
+            self.db.execute("DELETE FROM auth_keys WHERE user_id = ? AND dc_id = ?", (user_id, dc_id))
+
+
+auth_keys = AuthKeyStore(Var.METADATA_DB)
+media_session_pools: Dict[Tuple[Client, int], MediaSessionPool] = {}
+warmup_status = {"state": "disabled", "total": 0, "done": 0, "failed": 0}
+health_task: Optional[asyncio.Task] = None
+
+
+async def get_media_session_pool(client: Client, dc_id: int) -> MediaSessionPool:
+    """
+    Returns the started media session pool of a client for a DC, creating it if needed.
+    """
+    global health_task
+    pool = media_session_pools.get((client, dc_id))
+    if pool is None:
+        pool = media_session_pools[(client, dc_id)] = MediaSessionPool(client, dc_id, Var.MEDIA_SESSIONS_PER_DC)
+    if health_task is None:
+        health_task = asyncio.ensure_future(health_check_pools())
+    await pool.start()
+    return pool
+
+
+async def health_check_pools() -> None:
+    while True:
+        await asyncio.sleep(Var.MEDIA_SESSION_CHECK_INTERVAL)
+        for pool in list(media_session_pools.values()):
+            try:
+                await pool.health_check()
+            except Exception:
+                logging.exception(f"Health check of media sessions for DC {pool.dc_id} failed")
+
+
+async def warm_up_media_sessions(clients: List[Client], dc_ids: List[int]) -> None:
+    """
+    Opens the media sessions of every client to the given DCs in the background,
+    so the first viewer of a file doesn't wait for the authorization.
+    """
+    warmup_status.update(state="running", total=len(clients) * len(dc_ids), done=0, failed=0)
+    semaphore = asyncio.Semaphore(4)
+
+    async def warm_up(client: Client, dc_id: int) -> None:
+        async with semaphore:
+            try:
+                await get_media_session_pool(client, dc_id)
+                warmup_status["done"] += 1
+            except Exception as e:
+                warmup_status["failed"] += 1
+                logging.warning(f"Failed warming up media session for DC {dc_id}: {e!r}")
+
+    await asyncio.gather(*[warm_up(client, dc_id) for client in clients for dc_id in dc_ids])
+    warmup_status["state"] = "finished"
+    logging.info(f"Warmed up {warmup_status['done']} of {warmup_status['total']} media sessions")
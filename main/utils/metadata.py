@@ -0,0 +1,159 @@
+# This file is a part of TG-Direct-Link-Generator
+
+import time
+import sqlite3
+import logging
+from main.vars import Var
+from collections import Counter, OrderedDict
+from typing import List, NamedTuple, Optional, Tuple
+from pyrogram.file_id import FileId, FileType
+
+
+class FileRecord(NamedTuple):
+    """The properties of a media file that are needed to serve it."""
+    message_id: int
+    file_size: int
+    mime_type: str
+    file_name: str
+    unique_id: str
+    dc_id: int
+    file_type: int
+    media_id: int
+    access_hash: int
+    file_reference: bytes
+    thumbnail_size: str
+    date: int = 0
+    thumb_size: str = ""
+
+    @classmethod
+    def from_file_id(cls, file_id: FileId) -> "FileRecord":
+        return cls(
+            message_id=file_id.message_id,
+            file_size=file_id.file_size,
+            mime_type=file_id.mime_type,
+            file_name=file_id.file_name,
+            unique_id=file_id.unique_id,
+            dc_id=file_id.dc_id,
+            file_type=int(file_id.file_type),
+            media_id=file_id.media_id,
+            access_hash=file_id.access_hash,
+            file_reference=file_id.file_reference,
+            thumbnail_size=file_id.thumbnail_size,
+            date=getattr(file_id, "date", 0),
+            thumb_size=getattr(file_id, "thumb_size", ""),
+        )
+
+    def to_file_id(self) -> FileId:
+        file_id = FileId(
+            file_type=FileType(self.file_type),
+            dc_id=self.dc_id,
+            file_reference=self.file_reference,
+            media_id=self.media_id,
+            access_hash=self.access_hash,
+            thumbnail_size=self.thumbnail_size,
+        )
+        setattr(file_id, "file_size", self.file_size)
+        setattr(file_id, "mime_type", self.mime_type)
+        setattr(file_id, "file_name", self.file_name)
+        setattr(file_id, "unique_id", self.unique_id)
+        setattr(file_id, "message_id", self.message_id)
+        setattr(file_id, "date", self.date)
+        setattr(file_id, "thumb_size", self.thumb_size)
+        return file_id
+
+
+class MetadataStore:
+    def __init__(self, max_entries: int, ttl: int, db_path: str = ""):
+        """A cache of file properties by message ID, shared by every client.
+        attributes:
+            max_entries: how many records are kept in memory, the least recently used are dropped.
+            ttl: how many seconds a record stays valid.
+            db_path: an optional SQLite file the records are persisted to, so restarts start warm.
+
+        functions:
+            get: returns the cached properties of a message as a FileId, if they're still valid.
+            put: caches the properties of a message.
+            delete: drops the cached properties of a message.
+            top_dcs: returns the DCs that hold the most cached files.
+        """
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.records: "OrderedDict[int, Tuple[float, FileRecord]]" = OrderedDict()
+        self.db: Optional[sqlite3.Connection] = None
+        if db_path:
+            self.open(db_path)
+
+    def open(self, db_path: str) -> None:
+        self.db = sqlite3.connect(db_path, isolation_level=None, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS files ("
+            "message_id INTEGER PRIMARY KEY, expires REAL, file_size INTEGER, mime_type TEXT,"
+            " file_name TEXT, unique_id TEXT, dc_id INTEGER, file_type INTEGER, media_id INTEGER,"
+            " access_hash INTEGER, file_reference BLOB, thumbnail_size TEXT, date INTEGER DEFAULT 0,"
+            " thumb_size TEXT DEFAULT '')"
+        )
+        # the columns added after the first release of the table
+        columns = [row[1] for row in self.db.execute("PRAGMA table_info(files)")]
+        for column, definition in (("date", "INTEGER DEFAULT 0"), ("thumb_size", "TEXT DEFAULT ''")):
+            if column not in columns:
+                self.db.execute(f"ALTER TABLE files ADD COLUMN {column} {definition}")
+        self.db.execute("DELETE FROM files WHERE expires < ?", (time.time(),))
+        logging.info(f"Opened file metadata store at {db_path}")
+
+    def get(self, message_id: int) -> Optional[FileId]:
+        now = time.time()
+        cached = self.records.get(message_id)
+        if cached is None and self.db is not None:
+            row = self.db.execute(
+                "SELECT expires, message_id, file_size, mime_type, file_name, unique_id, dc_id, file_type,"
+                " media_id, access_hash, file_reference, thumbnail_size, date, thumb_size FROM files WHERE message_id = ?",
+                (message_id,),
+            ).fetchone()
+            if row is not None:
+                cached = (row[0], FileRecord(*row[1:]))
+                self._remember(message_id, cached)
+        if cached is None:
+            return None
+        expires, record = cached
+        if expires < now:
+            self.delete(message_id)
+            return None
+        self.records.move_to_end(message_id)
+        return record.to_file_id()
+
+    def put(self, file_id: FileId) -> None:
+        record = FileRecord.from_file_id(file_id)
+        expires = time.time() + self.ttl
+        self._remember(record.message_id, (expires, record))
+        if self.db is not None:
+            self.db.execute(
+                "INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (record.message_id, expires, *record[1:]),
+            )
+
+    def delete(self, message_id: int) -> None:
+        self.records.pop(message_id, None)
+        if self.db is not None:
+            self.db.execute("DELETE FROM files WHERE message_id = ?", (message_id,))
+
+    def top_dcs(self, count: int) -> List[int]:
+        """
+        Returns the DCs that hold the most cached files.
+        """
+        if self.db is not None:
+            rows = self.db.execute(
+                "SELECT dc_id FROM files GROUP BY dc_id ORDER BY COUNT(*) DESC LIMIT ?", (count,)
+            ).fetchall()
+            return [row[0] for row in rows]
+        dcs = Counter(record.dc_id for _, record in self.records.values())
+        return [dc_id for dc_id, _ in dcs.most_common(count)]
+
+    def _remember(self, message_id: int, cached: Tuple[float, FileRecord]) -> None:
+        self.records[message_id] = cached
+        self.records.move_to_end(message_id)
+        while len(self.records) > self.max_entries:
+            self.records.popitem(last=False)
+
+
+file_metadata = MetadataStore(Var.METADATA_CACHE_SIZE, Var.METADATA_TTL, Var.METADATA_DB)
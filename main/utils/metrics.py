@@ -0,0 +1,115 @@
+# This file is a part of TG-Direct-Link-Generator
+
+from bisect import bisect_left
+from typing import Callable, Dict, List, Sequence, Tuple
+
+# the latencies GetFile requests, first bytes and proxy calls are put in, in seconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def _labels(names: Sequence[str], values: Tuple, const: Sequence[Tuple[str, str]] = ()) -> str:
+    pairs = [f'{name}="{value}"' for name, value in const]
+    pairs += [f'{name}="{value}"' for name, value in zip(names, values)]
+    if not pairs:
+        return ""
+    return "{" + ",".join(pairs) + "}"
+
+
+class Counter:
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = ()):
+        """A counter that only goes up, one value per label set.
+        Updating it is a dict lookup and an addition, so it's fine on the hot path."""
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.values: Dict[Tuple, float] = {}
+
+    def inc(self, *labels, amount: float = 1) -> None:
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def render(self, const: Sequence[Tuple[str, str]] = ()) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        for labels, value in self.values.items():
+            lines.append(f"{self.name}{_labels(self.labels, labels, const)} {value}")
+        return lines
+
+
+class Gauge:
+    def __init__(
+        self, name: str, documentation: str, labels: Sequence[str],
+        collect: Callable[[], Dict[Tuple, float]], kind: str = "gauge",
+    ):
+        """Values read only when the metrics are scraped, from `collect`, so numbers
+        the app keeps anyway aren't counted twice. `kind` is "counter" for ones that only go up."""
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.collect = collect
+        self.kind = kind
+
+    def render(self, const: Sequence[Tuple[str, str]] = ()) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        for labels, value in self.collect().items():
+            lines.append(f"{self.name}{_labels(self.labels, labels, const)} {value}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = (), buckets: Sequence[float] = LATENCY_BUCKETS):
+        """A histogram of observed values, one per label set.
+        An observation only increments one bucket, the cumulative counts are summed when scraped."""
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        self.counts: Dict[Tuple, List[int]] = {}
+        self.sums: Dict[Tuple, float] = {}
+
+    def observe(self, value: float, *labels) -> None:
+        counts = self.counts.get(labels)
+        if counts is None:
+            counts = self.counts[labels] = [0] * (len(self.buckets) + 1)
+            self.sums[labels] = 0.0
+        counts[bisect_left(self.buckets, value)] += 1
+        self.sums[labels] += value
+
+    def render(self, const: Sequence[Tuple[str, str]] = ()) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        names = self.labels + ("le",)
+        for labels, counts in self.counts.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += count
+                lines.append(f"{self.name}_bucket{_labels(names, labels + (bound,), const)} {cumulative}")
+            lines.append(f"{self.name}_sum{_labels(self.labels, labels, const)} {self.sums[labels]}")
+            lines.append(f"{self.name}_count{_labels(self.labels, labels, const)} {cumulative}")
+        return lines
+
+
+registry: List = []
+
+
+def register(metric):
+    registry.append(metric)
+    return metric
+
+
+def render_metrics(const: Sequence[Tuple[str, str]] = ()) -> str:
+    """
+    Returns every registered metric in the Prometheus text format,
+    with the `const` (name, value) labels added to every sample.
+    """
+    lines = []
+    for metric in registry:
+        lines += metric.render(const)
+    return "\n".join(lines) + "\n"
+
+
+bytes_served = register(Counter("tg_bytes_served_total", "Bytes of telegram files sent to viewers, by the client that fetched them.", ["client"]))
+getfile_seconds = register(Histogram("tg_getfile_seconds", "Latency of upload.GetFile requests, by DC.", ["dc"]))
+getfile_errors = register(Counter("tg_getfile_errors_total", "Failed upload.GetFile requests, by DC.", ["dc"]))
+stream_first_byte_seconds = register(Histogram("tg_stream_first_byte_seconds", "Time from starting a stream to its first bytes."))
+streams_aborted = register(Counter("tg_streams_aborted_total", "Streams cut short once their chunk retries ran out, by client.", ["client"]))
+flood_waits = register(Counter("tg_flood_waits_total", "FloodWait errors, by client.", ["client"]))
+streams_rejected = register(Counter("tg_streams_rejected_total", "Streams refused by the per-IP and per-link caps, by cap.", ["cap"]))
+deno_seconds = register(Histogram("deno_proxy_seconds", "Duration of the Deno proxy calls, by outcome.", ["outcome"]))
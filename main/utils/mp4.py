@@ -0,0 +1,274 @@
+# This file is a part of TG-Direct-Link-Generator
+
+import time
+import struct
+import logging
+from collections import OrderedDict
+from main.vars import Var
+from pyrogram.file_id import FileId
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+from .single_flight import SingleFlight
+
+MP4_MIME_TYPES = {"video/mp4", "video/quicktime", "video/x-m4v", "audio/mp4", "audio/x-m4a"}
+MP4_EXTENSIONS = (".mp4", ".m4v", ".mov", ".m4a")
+# the boxes on the way from moov to the chunk offset tables
+CONTAINERS = {b"moov", b"trak", b"mdia", b"minf", b"stbl"}
+# top level boxes read before giving up on finding moov
+MAX_TOP_LEVEL_BOXES = 64
+MAX_MOOV_SIZE = 64 * 1024 * 1024
+# seconds a file whose boxes couldn't be read is served as uploaded before it's tried again
+FAILED_LAYOUT_TTL = 300
+
+
+def is_mp4(file_id: FileId) -> bool:
+    if file_id.mime_type in MP4_MIME_TYPES:
+        return True
+    return (file_id.file_name or "").lower().endswith(MP4_EXTENSIONS)
+
+
+def iter_boxes(data: bytes, start: int, end: int) -> Iterator[Tuple[bytes, int, int, int]]:
+    """
+    Yields the (type, offset, header size, size) of the boxes in data[start:end].
+    """
+    position = start
+    while position + 8 <= end:
+        size, kind = struct.unpack_from(">I4s", data, position)
+        header = 8
+        if size == 1:
+            size = struct.unpack_from(">Q", data, position + 8)[0]
+            header = 16
+        elif size == 0:
+            size = end - position
+        if size < header or position + size > end:
+            raise ValueError(f"Broken {kind!r} box at {position}")
+        yield kind, position, header, size
+        position += size
+
+
+def make_box(kind: bytes, body: bytes) -> bytes:
+    if len(body) + 8 > 0xFFFFFFFF:
+        return struct.pack(">I4sQ", 1, kind, len(body) + 16) + body
+    return struct.pack(">I4s", len(body) + 8, kind) + body
+
+
+def rebuild_moov(data: bytes, start: int, end: int, map_offset: Callable[[int], int], co64: bool) -> bytes:
+    """
+    Copies the boxes in data[start:end] with every chunk offset passed through map_offset.
+    With co64 every stco table is written as a co64 table.
+    """
+    boxes = []
+    for kind, position, header, size in iter_boxes(data, start, end):
+        body = position + header
+        if kind in CONTAINERS:
+            boxes.append(make_box(kind, rebuild_moov(data, body, position + size, map_offset, co64)))
+        elif kind in (b"stco", b"co64"):
+            count = struct.unpack_from(">I", data, body + 4)[0]
+            offsets = struct.unpack_from(f">{count}{'I' if kind == b'stco' else 'Q'}", data, body + 8)
+            offsets = [map_offset(offset) for offset in offsets]
+            table = struct.pack(f">{count}{'Q' if co64 or kind == b'co64' else 'I'}", *offsets)
+            boxes.append(make_box(
+                b"co64" if co64 else kind, data[body:body + 4] + struct.pack(">I", count) + table
+            ))
+        else:
+            boxes.append(data[position:position + size])
+    return b"".join(boxes)
+
+
+class Mp4Layout:
+    def __init__(self, file_size: int, insert_at: int, moov_start: int, moov_end: int, moov: bytes):
+        """The "faststart" layout of an MP4 file whose moov box is after its media data:
+        the patched moov is served right before the first mdat, the rest keeps its order.
+        attributes:
+            size: the size of the file as served.
+            moov: the patched moov box.
+            segments: (start, end, original start) of the served bytes, original start is None for moov.
+
+        functions:
+            map_range: returns the pieces a served byte range is made of.
+        """
+        self.moov = moov
+        self.size = file_size - (moov_end - moov_start) + len(moov)
+        moved = insert_at + len(moov)
+        self.segments = [
+            (0, insert_at, 0),
+            (insert_at, moved, None),
+            (moved, moov_start + len(moov), insert_at),
+            (moov_start + len(moov), self.size, moov_end),
+        ]
+
+    def map_range(self, first: int, last: int) -> List[Tuple[int, int, Optional[bytes]]]:
+        """
+        Returns the pieces of the served bytes first to last (inclusive) in order:
+        (first, last, None) for a range of the original file, or (0, 0, bytes) for a part of moov.
+        """
+        pieces = []
+        for start, end, original in self.segments:
+            low, high = max(first, start), min(last + 1, end)
+            if low >= high:
+                continue
+            if original is None:
+                pieces.append((0, 0, self.moov[low - start:high - start]))
+            else:
+                pieces.append((original + low - start, original + high - start - 1, None))
+        return pieces
+
+
+def build_layout(file_size: int, boxes: List[Tuple[bytes, int, int, int]], moov: bytes) -> Optional[Mp4Layout]:
+    """
+    Returns the faststart layout for the top level boxes of a file and its moov box,
+    or None if moov is already in front of the media data.
+    """
+    kinds = [kind for kind, *_ in boxes]
+    if b"moof" in kinds:
+        # fragmented files start playing without the full index anyway
+        return None
+    insert_at = next(position for kind, position, _, _ in boxes if kind == b"mdat")
+    _, moov_start, header, moov_size = next(box for box in boxes if box[0] == b"moov")
+    if moov_start < insert_at:
+        return None
+    moov_end = moov_start + moov_size
+
+    def rebuild(co64: bool) -> bytes:
+        # the patched size doesn't depend on the offsets, so a dry run tells it
+        size = len(make_box(b"moov", rebuild_moov(moov, header, len(moov), lambda o: 0, co64)))
+
+        def map_offset(offset: int) -> int:
+            if offset < insert_at:
+                return offset
+            if offset < moov_start:
+                return offset + size
+            return offset - moov_size + size
+
+        return make_box(b"moov", rebuild_moov(moov, header, len(moov), map_offset, co64))
+
+    try:
+        patched = rebuild(co64=False)
+    except struct.error:
+        # an offset doesn't fit stco anymore
+        patched = rebuild(co64=True)
+    return Mp4Layout(file_size, insert_at, moov_start, moov_end, patched)
+
+
+async def read_top_level_boxes(
+    streamer, file_id: FileId, max_boxes: int, stop_at: Optional[bytes] = None
+) -> Optional[List[Tuple[bytes, int, int, int]]]:
+    """
+    Reads the (type, offset, header size, size) of the top level boxes of a file through a ByteStreamer,
+    up to `max_boxes` boxes or the first box of type `stop_at`. Returns None if the file isn't MP4 shaped.
+    """
+    file_size = file_id.file_size
+    boxes = []
+    position = 0
+    while position < file_size and len(boxes) < max_boxes:
+        header = await streamer.read_bytes(file_id, position, 16)
+        if len(header) < 8:
+            return None
+        size, kind = struct.unpack_from(">I4s", header)
+        header_size = 8
+        if size == 1:
+            size = struct.unpack_from(">Q", header, 8)[0]
+            header_size = 16
+        elif size == 0:
+            size = file_size - position
+        if size < header_size:
+            return None
+        boxes.append((kind, position, header_size, size))
+        if kind == stop_at:
+            break
+        position += size
+    return boxes
+
+
+class Mp4LayoutCache:
+    def __init__(self, max_bytes: int):
+        """An LRU cache of the faststart layouts of MP4 files, by unique ID.
+        Files that don't need one are cached as None, so they are only inspected once.
+        Files whose boxes couldn't be read are served as uploaded for FAILED_LAYOUT_TTL seconds.
+        attributes:
+            max_bytes: the byte budget of the cached moov boxes, 0 disables faststart serving.
+
+        functions:
+            uninspected: tells if a file may need a layout that wasn't read yet.
+            get: returns the layout of a file, reading its box index through a ByteStreamer if needed.
+        """
+        self.max_bytes = max_bytes
+        self.used_bytes = 0
+        self.layouts: "OrderedDict[str, Optional[Mp4Layout]]" = OrderedDict()
+        self.failed: Dict[str, float] = {}
+        self.builds = SingleFlight()
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_bytes > 0
+
+    def uninspected(self, file_id: FileId) -> bool:
+        if not self.enabled or not is_mp4(file_id) or not file_id.file_size:
+            return False
+        return file_id.unique_id not in self.layouts and not self.recently_failed(file_id.unique_id)
+
+    def recently_failed(self, key: str) -> bool:
+        failed_until = self.failed.get(key)
+        if failed_until is None:
+            return False
+        if time.monotonic() < failed_until:
+            return True
+        del self.failed[key]
+        return False
+
+    async def get(self, streamer, file_id: FileId) -> Optional[Mp4Layout]:
+        if not self.enabled or not is_mp4(file_id) or not file_id.file_size:
+            return None
+        key = file_id.unique_id
+        if key in self.layouts:
+            self.layouts.move_to_end(key)
+            return self.layouts[key]
+        if self.recently_failed(key):
+            return None
+        return await self.builds.do(key, lambda: self.build(streamer, file_id))
+
+    async def build(self, streamer, file_id: FileId) -> Optional[Mp4Layout]:
+        try:
+            layout = await self.read_layout(streamer, file_id)
+        except Exception as e:
+            logging.warning(f"Failed reading the MP4 index of {file_id.unique_id}: {e!r}")
+            now = time.monotonic()
+            if len(self.failed) >= Var.METADATA_CACHE_SIZE:
+                self.failed = {key: until for key, until in self.failed.items() if until > now}
+            self.failed[file_id.unique_id] = now + FAILED_LAYOUT_TTL
+            return None
+        self.put(file_id.unique_id, layout)
+        if layout is not None:
+            logging.debug(f"Serving {file_id.unique_id} with its {len(layout.moov)} bytes moov moved to the front")
+        return layout
+
+    @staticmethod
+    async def read_layout(streamer, file_id: FileId) -> Optional[Mp4Layout]:
+        file_size = file_id.file_size
+        # a fragmented file is told by its first moof, the boxes after it don't matter
+        boxes = await read_top_level_boxes(streamer, file_id, MAX_TOP_LEVEL_BOXES, stop_at=b"moof")
+        if boxes is None:
+            return None
+        kinds = [kind for kind, *_ in boxes]
+        if b"moov" not in kinds or b"mdat" not in kinds:
+            return None
+        _, moov_start, _, moov_size = next(box for box in boxes if box[0] == b"moov")
+        if moov_size > MAX_MOOV_SIZE or kinds.index(b"moov") < kinds.index(b"mdat"):
+            return None
+        moov = await streamer.read_bytes(file_id, moov_start, moov_size)
+        if len(moov) != moov_size:
+            return None
+        try:
+            return build_layout(file_size, boxes, moov)
+        except (ValueError, struct.error) as e:
+            logging.info(f"Can't rearrange the MP4 boxes of {file_id.unique_id}: {e!r}")
+            return None
+
+    def put(self, key: str, layout: Optional[Mp4Layout]) -> None:
+        self.layouts[key] = layout
+        self.used_bytes += len(layout.moov) if layout else 0
+        while self.used_bytes > self.max_bytes or len(self.layouts) > Var.METADATA_CACHE_SIZE:
+            _, victim = self.layouts.popitem(last=False)
+            self.used_bytes -= len(victim.moov) if victim else 0
+
+
+mp4_layouts = Mp4LayoutCache(Var.MP4_INDEX_CACHE_SIZE * 1024 * 1024)
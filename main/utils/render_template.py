@@ -1,38 +1,53 @@
 # This file is a part of TG-Direct-Link-Generator
 
 from main.vars import Var
-from main.bot import StreamBot
+from main.bot import multi_clients
 from main.utils.human_readable import humanbytes
 from main.utils.file_properties import get_file_ids
+from main.utils.metadata import file_metadata
+from main.utils.hls import hls_indexes
+from main.utils.scheduler import scheduler
 from main.server.exceptions import InvalidHash
 import urllib.parse
-import aiofiles
 import logging
-import aiohttp
+import os
+
+TEMPLATE_DIR = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'template')
+
+
+def load_template(name):
+    with open(os.path.join(TEMPLATE_DIR, name)) as r:
+        return r.read()
+
+
+# the templates are read once, the player page is prepared for each media tag
+PLAYER_TEMPLATE = load_template('req.html')
+PLAYER_TEMPLATES = {tag: PLAYER_TEMPLATE.replace('tag', tag) for tag in ('video', 'audio')}
+DOWNLOAD_TEMPLATE = load_template('dl.html')
 
 
 async def render_page(message_id, secure_hash):
-    file_data=await get_file_ids(StreamBot, int(Var.BIN_CHANNEL), int(message_id))
+    file_data = file_metadata.get(int(message_id))
+    if file_data is None:
+        file_data = await get_file_ids(multi_clients[scheduler.pick()], int(Var.BIN_CHANNEL), int(message_id))
     if file_data.unique_id[:6] != secure_hash:
         logging.debug(f'link hash: {secure_hash} - {file_data.unique_id[:6]}')
         logging.debug(f"Invalid hash for message with - ID {message_id}")
         raise InvalidHash
     src = urllib.parse.urljoin(Var.URL, f'{secure_hash}{str(message_id)}')
-    if str(file_data.mime_type.split('/')[0].strip()) == 'video':
-        async with aiofiles.open('main/template/req.html') as r:
-            heading = 'Watch {}'.format(file_data.file_name)
-            tag = file_data.mime_type.split('/')[0].strip()
-            html = (await r.read()).replace('tag', tag) % (heading, file_data.file_name, src)
-    elif str(file_data.mime_type.split('/')[0].strip()) == 'audio':
-        async with aiofiles.open('main/template/req.html') as r:
-            heading = 'Listen {}'.format(file_data.file_name)
-            tag = file_data.mime_type.split('/')[0].strip()
-            html = (await r.read()).replace('tag', tag) % (heading, file_data.file_name, src)
+    # MP4s not yet found unservable are offered a playlist, requesting it is what reads the index
+    hls_src = ''
+    if hls_indexes.offered(file_data):
+        hls_src = urllib.parse.urljoin(Var.URL, f'hls/{secure_hash}{str(message_id)}.m3u8')
+    tag = str(file_data.mime_type.split('/')[0].strip())
+    if tag == 'video':
+        heading = 'Watch {}'.format(file_data.file_name)
+        html = PLAYER_TEMPLATES[tag] % (heading, file_data.file_name, src, hls_src)
+    elif tag == 'audio':
+        heading = 'Listen {}'.format(file_data.file_name)
+        html = PLAYER_TEMPLATES[tag] % (heading, file_data.file_name, src, hls_src)
     else:
-        async with aiofiles.open('main/template/dl.html') as r:
-            async with aiohttp.ClientSession() as s:
-                async with s.get(src) as u:
-                    heading = 'Download {}'.format(file_data.file_name)
-                    file_size = humanbytes(int(u.headers.get('Content-Length')))
-                    html = (await r.read()) % (heading, file_data.file_name, src, file_size)
+        heading = 'Download {}'.format(file_data.file_name)
+        file_size = humanbytes(file_data.file_size)
+        html = DOWNLOAD_TEMPLATE % (heading, file_data.file_name, src, file_size)
     return html
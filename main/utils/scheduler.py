@@ -0,0 +1,174 @@
+# This file is a part of TG-Direct-Link-Generator
+
+import math
+import time
+import logging
+from main.vars import Var
+from pyrogram import Client
+from typing import Dict, Iterable, List, Optional, Tuple
+from main.bot import multi_clients, work_loads
+from .media_sessions import media_session_pools
+from .metrics import flood_waits
+
+
+class ClientStats:
+    __slots__ = ("in_flight", "speed", "errors", "errors_at", "blocked_until")
+
+    # how fast recent errors are forgotten
+    ERROR_HALF_LIFE = 60.0
+
+    def __init__(self):
+        """The live numbers of a client the scheduler decides on.
+        attributes:
+            in_flight: the GetFile requests the client is waiting for.
+            speed: moving average of the bytes/sec of a single GetFile request, 0 until measured.
+            errors: recent failed requests, decaying with ERROR_HALF_LIFE.
+            blocked_until: when the client may be used again after a FloodWait.
+        """
+        self.in_flight = 0
+        self.speed = 0.0
+        self.errors = 0.0
+        self.errors_at = 0.0
+        self.blocked_until = 0.0
+
+    def recent_errors(self, now: float) -> float:
+        if not self.errors:
+            return 0.0
+        return self.errors * 0.5 ** ((now - self.errors_at) / self.ERROR_HALF_LIFE)
+
+
+class Scheduler:
+    """Picks the client that serves a new stream and collects the stats it needs.
+    The stats are updated on every GetFile, so recording them is kept to a few operations.
+    A client that got a FloodWait is skipped until the wait is over (circuit breaker).
+    The client with the highest score is picked, by default the one with the fewest open streams."""
+
+    def __init__(self):
+        self.stats: Dict[Client, ClientStats] = {}
+
+    def client_stats(self, client: Client) -> ClientStats:
+        stats = self.stats.get(client)
+        if stats is None:
+            stats = self.stats[client] = ClientStats()
+        return stats
+
+    def request_started(self, client: Client) -> float:
+        self.client_stats(client).in_flight += 1
+        return time.monotonic()
+
+    def request_finished(self, client: Client, started: float, size: int) -> None:
+        stats = self.client_stats(client)
+        stats.in_flight -= 1
+        elapsed = time.monotonic() - started
+        if size and elapsed > 0:
+            speed = size / elapsed
+            stats.speed = speed if not stats.speed else stats.speed * 0.8 + speed * 0.2
+
+    def request_failed(self, client: Client, weight: float = 1.0) -> None:
+        stats = self.client_stats(client)
+        stats.in_flight -= 1
+        now = time.monotonic()
+        stats.errors = stats.recent_errors(now) + weight
+        stats.errors_at = now
+
+    def trip(self, client: Client, seconds: float) -> None:
+        """
+        Takes a client out of rotation for `seconds`, e.g. after a FloodWait.
+        """
+        stats = self.client_stats(client)
+        now = time.monotonic()
+        flood_waits.inc(self.index_of(client))
+        if stats.blocked_until <= now:
+            logging.warning(f"Client {self.index_of(client)} is taken out of rotation for {seconds}s")
+        stats.blocked_until = max(stats.blocked_until, now + seconds)
+
+    def blocked_for(self, client: Client) -> float:
+        return max(0.0, self.client_stats(client).blocked_until - time.monotonic())
+
+    @staticmethod
+    def index_of(client: Client) -> Optional[int]:
+        for index, c in multi_clients.items():
+            if c is client:
+                return index
+        return None
+
+    def candidates(self, exclude: Iterable[int], now: float) -> List[Tuple[int, Client]]:
+        """
+        Returns the clients that may get new work: the ones not blocked by a FloodWait,
+        preferring the ones not in `exclude`. If every client is blocked, the one that
+        gets free first.
+        """
+        clients = [(index, client) for index, client in multi_clients.items() if index in work_loads]
+        available = [(i, c) for i, c in clients if self.client_stats(c).blocked_until <= now]
+        preferred = [(i, c) for i, c in available if i not in exclude]
+        if preferred or available:
+            return preferred or available
+        return [min(clients, key=lambda ic: self.client_stats(ic[1]).blocked_until)] if clients else []
+
+    def pick(self, dc_id: Optional[int] = None, exclude: Iterable[int] = ()) -> int:
+        now = time.monotonic()
+        best, best_score = None, -math.inf
+        for index, client in self.candidates(exclude, now):
+            score = self.score(index, client, dc_id, now)
+            if score > best_score:
+                best, best_score = index, score
+        if best is None:
+            return min(work_loads, key=work_loads.get)
+        logging.debug(f"Scheduler picked client {best} for DC {dc_id} with score {best_score:.0f}")
+        return best
+
+    def describe(self, dc_id: Optional[int] = None) -> List[dict]:
+        """
+        Returns the inputs the scheduler decides on, for every client.
+        """
+        now = time.monotonic()
+        described = []
+        for index, client in multi_clients.items():
+            stats = self.client_stats(client)
+            described.append({
+                "client": index,
+                "streams": work_loads.get(index, 0),
+                "in_flight": stats.in_flight,
+                "speed": round(stats.speed),
+                "recent_errors": round(stats.recent_errors(now), 2),
+                "blocked_for": round(max(0.0, stats.blocked_until - now)),
+                "warm_dcs": sorted(dc for (c, dc), pool in media_session_pools.items() if c is client and pool.sessions),
+                "score": round(self.score(index, client, dc_id, now), 2),
+            })
+        return described
+
+    def score(self, index: int, client: Client, dc_id: Optional[int], now: float) -> float:
+        return -work_loads.get(index, 0)
+
+
+class LeastLoadedScheduler(Scheduler):
+    """Picks the client with the fewest open streams."""
+
+
+class ThroughputScheduler(Scheduler):
+    """Picks the client expected to give a new stream the most bytes/sec: its measured
+    speed shared with its open streams and requests, lowered by recent errors and by
+    not having a media session to the file's DC yet."""
+
+    # the speed assumed for a client that hasn't served anything yet
+    DEFAULT_SPEED = 1024 * 1024
+    COLD_DC_PENALTY = 0.5
+
+    def score(self, index: int, client: Client, dc_id: Optional[int], now: float) -> float:
+        stats = self.client_stats(client)
+        speed = stats.speed or self.DEFAULT_SPEED
+        load = 1 + work_loads.get(index, 0) + stats.in_flight / max(1, Var.PREFETCH_WINDOW)
+        score = speed / load * 0.5 ** stats.recent_errors(now)
+        if dc_id is not None:
+            pool = media_session_pools.get((client, dc_id))
+            if pool is None or not pool.sessions:
+                score *= self.COLD_DC_PENALTY
+        return score
+
+
+schedulers = {
+    "least_loaded": LeastLoadedScheduler,
+    "throughput": ThroughputScheduler,
+}
+
+scheduler: Scheduler = schedulers.get(Var.SCHEDULER, ThroughputScheduler)()
@@ -0,0 +1,160 @@
+# This file is a part of TG-Direct-Link-Generator
+
+import time
+from main.vars import Var
+from typing import Dict, Hashable, Optional
+from .metrics import streams_rejected
+
+# a bucket holds this many seconds of its rate, so short bursts (and a player's read-ahead) aren't delayed
+BURST_SECONDS = 2.0
+MIN_BURST = 1024 * 1024
+# idle IPs and links are forgotten once more than this many are tracked
+MAX_TRACKED = 4096
+
+
+class TokenBucket:
+    __slots__ = ("tokens", "updated")
+
+    def __init__(self):
+        """Bytes a stream may send right away. It may go into debt: a chunk is always sent,
+        the stream then waits until the debt is paid back at the bucket's rate.
+        The rate is passed on every take, so a fair share can change while streams run."""
+        self.tokens = None
+        self.updated = time.monotonic()
+
+    def take(self, amount: int, rate: float) -> float:
+        """
+        Takes `amount` bytes out of the bucket and returns the seconds to wait before sending them.
+        """
+        now = time.monotonic()
+        burst = max(rate * BURST_SECONDS, MIN_BURST)
+        if self.tokens is None:
+            self.tokens = burst
+        else:
+            self.tokens = min(burst, self.tokens + (now - self.updated) * rate)
+        self.updated = now
+        self.tokens -= amount
+        return -self.tokens / rate if self.tokens < 0 else 0.0
+
+    def refilled(self, rate: float) -> bool:
+        if self.tokens is None:
+            return True
+        return self.tokens + (time.monotonic() - self.updated) * rate >= max(rate * BURST_SECONDS, MIN_BURST)
+
+
+class _Usage:
+    __slots__ = ("streams", "bucket")
+
+    def __init__(self):
+        self.streams = 0
+        self.bucket = TokenBucket()
+
+
+class StreamLease:
+    __slots__ = ("shaper", "ip", "link", "released")
+
+    def __init__(self, shaper: "TrafficShaper", ip: _Usage, link: _Usage):
+        """A stream let through by a TrafficShaper.
+        functions:
+            consume: accounts for bytes about to be sent, returns the seconds to wait first.
+            release: frees the stream's slot, calling it again does nothing.
+        """
+        self.shaper = shaper
+        self.ip = ip
+        self.link = link
+        self.released = False
+
+    def consume(self, amount: int) -> float:
+        shaper = self.shaper
+        delay = 0.0
+        rate = shaper.ip_rate()
+        if rate:
+            delay = self.ip.bucket.take(amount, rate)
+        if shaper.link_rate:
+            delay = max(delay, self.link.bucket.take(amount, shaper.link_rate))
+        return delay
+
+    def release(self) -> None:
+        if self.released:
+            return
+        self.released = True
+        self.ip.streams -= 1
+        self.link.streams -= 1
+        if not self.ip.streams:
+            self.shaper.active_ips -= 1
+
+
+class TrafficShaper:
+    def __init__(self, ip_rate: int, link_rate: int, total_rate: int, ip_streams: int, link_streams: int):
+        """Shares the telegram-backed streams fairly between viewers:
+        caps the concurrent streams of a client IP and of a link, and the bytes/sec they are sent at.
+        With a total rate every IP that is streaming gets an equal share of it.
+        attributes:
+            ip_rate, link_rate, total_rate: bytes/sec, 0 for unlimited.
+            ip_streams, link_streams: concurrent streams, 0 for unlimited.
+            active_ips: the IPs with at least one stream.
+
+        functions:
+            open: returns a StreamLease for a new stream, or None if a cap is reached.
+        """
+        self.max_ip_rate = ip_rate
+        self.link_rate = link_rate
+        self.total_rate = total_rate
+        self.ip_streams = ip_streams
+        self.link_streams = link_streams
+        self.active_ips = 0
+        self.ips: Dict[str, _Usage] = {}
+        self.links: Dict[Hashable, _Usage] = {}
+
+    @property
+    def enabled(self) -> bool:
+        return any((self.max_ip_rate, self.link_rate, self.total_rate, self.ip_streams, self.link_streams))
+
+    def ip_rate(self) -> float:
+        if not self.total_rate:
+            return self.max_ip_rate
+        share = self.total_rate / max(1, self.active_ips)
+        return min(self.max_ip_rate, share) if self.max_ip_rate else share
+
+    def open(self, ip: str, link: Hashable) -> Optional[StreamLease]:
+        ip_usage = self.usage(self.ips, ip, self.ip_rate())
+        link_usage = self.usage(self.links, link, self.link_rate)
+        if self.ip_streams and ip_usage.streams >= self.ip_streams:
+            streams_rejected.inc("ip")
+            return None
+        if self.link_streams and link_usage.streams >= self.link_streams:
+            streams_rejected.inc("link")
+            return None
+        if not ip_usage.streams:
+            self.active_ips += 1
+        ip_usage.streams += 1
+        link_usage.streams += 1
+        return StreamLease(self, ip_usage, link_usage)
+
+    @staticmethod
+    def usage(usages: Dict[Hashable, _Usage], key: Hashable, rate: float) -> _Usage:
+        usage = usages.get(key)
+        if usage is not None:
+            return usage
+        if len(usages) >= MAX_TRACKED:
+            # an idle key is only forgotten once its bucket is full again, so reconnecting doesn't reset it
+            for idle in [k for k, u in usages.items() if not u.streams and (not rate or u.bucket.refilled(rate))]:
+                del usages[idle]
+        usage = usages[key] = _Usage()
+        return usage
+
+    def describe(self) -> dict:
+        return {
+            "active_ips": self.active_ips,
+            "ip_rate": int(self.ip_rate()),
+            "streams": sum(usage.streams for usage in self.ips.values()),
+        }
+
+
+shaper = TrafficShaper(
+    Var.STREAM_RATE_PER_IP * 1024,
+    Var.STREAM_RATE_PER_LINK * 1024,
+    Var.STREAM_RATE_TOTAL * 1024,
+    Var.STREAMS_PER_IP,
+    Var.STREAMS_PER_LINK,
+)
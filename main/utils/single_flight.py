@@ -0,0 +1,36 @@
+# This file is a part of TG-Direct-Link-Generator
+
+import asyncio
+from typing import Any, Awaitable, Callable, Dict, Hashable
+
+
+class SingleFlight:
+    def __init__(self):
+        """Runs at most one call per key at a time, concurrent callers with the same key
+        wait for the call in flight and all get its result.
+        attributes:
+            calls: the calls in flight, by key.
+            shared: how many callers were answered by a call started by someone else.
+
+        The call runs in its own task, so a caller that goes away (e.g. a closed
+        connection) doesn't cancel it for the others.
+        """
+        self.calls: Dict[Hashable, asyncio.Future] = {}
+        self.shared = 0
+
+    async def do(self, key: Hashable, fn: Callable[[], Awaitable[Any]]) -> Any:
+        task = self.calls.get(key)
+        if task is None:
+            task = asyncio.ensure_future(fn())
+            self.calls[key] = task
+            task.add_done_callback(lambda t: self._done(key, t))
+        else:
+            self.shared += 1
+        return await asyncio.shield(task)
+
+    def _done(self, key: Hashable, task: asyncio.Future) -> None:
+        if self.calls.get(key) is task:
+            del self.calls[key]
+        if not task.cancelled():
+            # mark the exception as retrieved, the waiters (if any) already got it
+            task.exception()
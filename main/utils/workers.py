@@ -0,0 +1,131 @@
+# This file is a part of TG-Direct-Link-Generator
+
+import os
+import sys
+import time
+import signal
+import logging
+import subprocess
+from main.vars import Var
+from typing import Dict, List, Optional
+from .config_parser import TokenParser
+
+# a worker that ran this long before exiting is restarted right away, otherwise after a growing delay
+STABLE_AFTER = 60
+MAX_RESTART_DELAY = 60
+# seconds the workers get to stop before they're killed
+STOP_TIMEOUT = 15
+DEFAULT_SHARED_DB = "metadata.db"
+
+
+def worker_tokens(tokens: Dict[int, str], index: int, count: int) -> Dict[int, str]:
+    """
+    Returns the MULTI_TOKEN clients a worker owns: client i belongs to worker i % count,
+    so worker 0, which also runs the main bot, gets client 0.
+    """
+    return {client_id: token for client_id, token in tokens.items() if client_id % count == index}
+
+
+def worker_count() -> int:
+    """
+    Returns how many workers are started: WEB_WORKERS, but no more than there are clients to share.
+    """
+    return max(1, min(Var.WEB_WORKERS, 1 + len(TokenParser().parse_from_env())))
+
+
+def worker_env(index: int, count: int) -> Dict[str, str]:
+    """
+    Returns the environment of a worker: its index, and the caches split between the workers.
+    Every worker reads and writes the same metadata store, so a file looked up by one is known to all.
+    """
+    env = dict(os.environ)
+    env["WORKER_INDEX"] = str(index)
+    env["WEB_WORKERS"] = str(count)
+    env["METADATA_DB"] = Var.METADATA_DB or DEFAULT_SHARED_DB
+    env["MEMORY_CACHE_SIZE"] = str(Var.MEMORY_CACHE_SIZE // count)
+    # the disk cache index lives in memory, so every worker keeps its own directory,
+    # next to DISK_CACHE_DIR rather than in it, where it would be taken for a cached file
+    env["DISK_CACHE_DIR"] = f"{os.path.normpath(Var.DISK_CACHE_DIR)}-worker-{index}"
+    env["DISK_CACHE_SIZE"] = str(Var.DISK_CACHE_SIZE // count)
+    return env
+
+
+class Worker:
+    def __init__(self, index: int, count: int):
+        """A worker process serving on the shared port (SO_REUSEPORT) with its part of the clients.
+        attributes:
+            process: the running process, None while it waits to be restarted.
+            crashes: exits in a row that came before the worker ran STABLE_AFTER seconds.
+
+        functions:
+            start: starts the process.
+            check: restarts the process if it exited, after its backoff.
+        """
+        self.index = index
+        self.count = count
+        self.process: Optional[subprocess.Popen] = None
+        self.started = 0.0
+        self.crashes = 0
+        self.restart_at = 0.0
+
+    def start(self) -> None:
+        self.process = subprocess.Popen([sys.executable, "-m", "main"], env=worker_env(self.index, self.count))
+        self.started = time.monotonic()
+        logging.info(f"Started worker {self.index} (pid {self.process.pid})")
+
+    def check(self) -> None:
+        now = time.monotonic()
+        if self.process is None:
+            if now >= self.restart_at:
+                self.start()
+            return
+        code = self.process.poll()
+        if code is None:
+            return
+        self.crashes = 0 if now - self.started >= STABLE_AFTER else self.crashes + 1
+        delay = min(MAX_RESTART_DELAY, 2 ** self.crashes - 1)
+        logging.warning(f"Worker {self.index} exited with code {code}, restarting it in {delay}s")
+        self.process = None
+        self.restart_at = now + delay
+
+    def stop(self) -> None:
+        if self.process is not None and self.process.poll() is None:
+            self.process.send_signal(signal.SIGTERM)
+
+
+def supervise() -> int:
+    """
+    Runs the workers and restarts the ones that exit, until SIGINT or SIGTERM.
+    """
+    count = worker_count()
+    workers: List[Worker] = [Worker(index, count) for index in range(count)]
+    stopping = []
+
+    def stop(signum, _):
+        if not stopping:
+            logging.info(f"Stopping {count} workers")
+        stopping.append(signum)
+
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+    for worker in workers:
+        worker.start()
+    while True:
+        time.sleep(1)
+        if stopping:
+            break
+        for worker in workers:
+            worker.check()
+
+    for worker in workers:
+        worker.stop()
+    deadline = time.monotonic() + STOP_TIMEOUT
+    for worker in workers:
+        if worker.process is None:
+            continue
+        try:
+            worker.process.wait(max(0.0, deadline - time.monotonic()))
+        except subprocess.TimeoutExpired:
+            logging.warning(f"Killing worker {worker.index}, it didn't stop in time")
+            worker.process.kill()
+    return 0
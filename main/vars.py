@@ -16,7 +16,39 @@ class Var(object):
     BIN_CHANNEL = int(
         environ.get("BIN_CHANNEL", None)
     )  # you NEED to use a CHANNEL when you're using MULTI_CLIENT
+    PREFETCH_WINDOW = int(environ.get("PREFETCH_WINDOW", "4"))  # GetFile requests in flight per stream
+    CHUNK_RETRIES = int(environ.get("CHUNK_RETRIES", "5"))  # retries of a failed chunk before a stream gives up
+    MEDIA_SESSIONS_PER_DC = int(environ.get("MEDIA_SESSIONS_PER_DC", "2"))  # per client
+    MEDIA_SESSION_CHECK_INTERVAL = int(environ.get("MEDIA_SESSION_CHECK_INTERVAL", "60"))  # seconds
+    WARMUP_MEDIA_SESSIONS = str(environ.get("WARMUP_MEDIA_SESSIONS", False)).lower() == "true"
+    WARMUP_DCS = list(int(x) for x in str(environ.get("WARMUP_DCS", "")).split())  # most used DCs if empty
+    SCHEDULER = str(environ.get("SCHEDULER", "throughput"))  # throughput or least_loaded
+    FLOOD_WAIT_THRESHOLD = int(environ.get("FLOOD_WAIT_THRESHOLD", "60"))  # seconds a stream waits when every bot is flood waited
+    STRIPED_STREAMING = str(environ.get("STRIPED_STREAMING", False)).lower() == "true"
+    STRIPE_MAX_LOAD = int(environ.get("STRIPE_MAX_LOAD", "1"))  # clients below this load join a stripe
+    METADATA_CACHE_SIZE = int(environ.get("METADATA_CACHE_SIZE", "10000"))  # files kept in memory
+    METADATA_TTL = int(environ.get("METADATA_TTL", "3600"))  # 1 hour
+    METADATA_DB = str(environ.get("METADATA_DB", ""))  # SQLite file to persist file metadata to
+    METADATA_BATCH_DELAY = int(environ.get("METADATA_BATCH_DELAY", "10"))  # ms to collect message lookups
+    MEMORY_CACHE_SIZE = int(environ.get("MEMORY_CACHE_SIZE", "64"))  # in MiB, 0 disables the memory cache
+    DISK_CACHE_DIR = str(environ.get("DISK_CACHE_DIR", "cache"))
+    DISK_CACHE_SIZE = int(environ.get("DISK_CACHE_SIZE", "0"))  # in MiB, 0 disables the disk cache
+    DISK_CACHE_ADMIT = int(environ.get("DISK_CACHE_ADMIT", "2"))  # requests before a chunk is cached
+    MP4_INDEX_CACHE_SIZE = int(environ.get("MP4_INDEX_CACHE_SIZE", "32"))  # in MiB, 0 disables faststart serving
+    STREAMS_PER_IP = int(environ.get("STREAMS_PER_IP", "0"))  # concurrent streams of a client IP, 0 for unlimited
+    STREAMS_PER_LINK = int(environ.get("STREAMS_PER_LINK", "0"))  # concurrent streams of a link, 0 for unlimited
+    STREAM_RATE_PER_IP = int(environ.get("STREAM_RATE_PER_IP", "0"))  # in KiB/s, 0 for unlimited
+    STREAM_RATE_PER_LINK = int(environ.get("STREAM_RATE_PER_LINK", "0"))  # in KiB/s, 0 for unlimited
+    STREAM_RATE_TOTAL = int(environ.get("STREAM_RATE_TOTAL", "0"))  # in KiB/s, split evenly between streaming IPs
+    TRUST_PROXY_HEADERS = str(environ.get("TRUST_PROXY_HEADERS", False)).lower() == "true"
+    HTML_REWRITER = str(environ.get("HTML_REWRITER", "python")).lower()  # python (in-process, streaming) or deno
+    HTML_REWRITE_WORKERS = int(environ.get("HTML_REWRITE_WORKERS", "2"))  # processes big proxied pages are rewritten in
+    DENO_WORKERS = int(environ.get("DENO_WORKERS", "1"))  # Deno proxy workers kept running
+    DENO_MAX_WORKERS = int(environ.get("DENO_MAX_WORKERS", "4"))  # Deno proxy workers under load
+    DENO_WORKER_MAX_REQUESTS = int(environ.get("DENO_WORKER_MAX_REQUESTS", "1000"))  # requests before a worker is replaced, 0 for never
     PORT = int(environ.get("PORT", 8080))
+    WEB_WORKERS = int(environ.get("WEB_WORKERS", "1"))  # processes sharing PORT, each with its part of the clients
+    WORKER_INDEX = int(environ.get("WORKER_INDEX", "-1"))  # set by the supervisor for its workers
     BIND_ADDRESS = str(environ.get("WEB_SERVER_BIND_ADDRESS", "0.0.0.0"))
     PING_INTERVAL = int(environ.get("PING_INTERVAL", "1200"))  # 20 minutes
     HAS_SSL = environ.get("HAS_SSL", False)